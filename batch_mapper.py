@@ -0,0 +1,195 @@
+# Build a world map offline from a recorded run (see telemetry_log.py).
+# Frames are classified and projected into the world a whole batch at a time
+# instead of one frame at a time through the Rover, and the chunks of the run
+# are spread over several processes.
+# Example: $ python batch_mapper.py run_folder --output map.png --processes 4
+#          $ python batch_mapper.py run_folder --map_resolution 4 --output map.png
+import argparse
+import json
+import multiprocessing
+import time
+import cv2
+import numpy as np
+
+from perception import CameraModel, TerrainClassifier, NAVIGABLE, OBSTACLE, ROCK
+from occupancy import OccupancyGrid, LOGODDS_FREE, LOGODDS_OCCUPIED, LOGODDS_LIMIT, ROCK_LIMIT
+from rock_index import RockIndex
+from rover_state import load_ground_truth, WORLD_SIZE
+from tiled_map import TILE_METERS
+from supporting_functions import convert_to_float
+from telemetry_log import TelemetryReader
+
+# Define a function to read the poses of a batch of telemetry dicts.
+# Returns x, y, yaw arrays and a mask of the frames fit for mapping (rover
+# level and not picking up a sample, as in perception_step()).
+def batch_poses(telemetry):
+    positions = np.array([[convert_to_float(pos) for pos in data['position'].split(';')] for data in telemetry])
+    yaws = np.array([convert_to_float(data['yaw']) for data in telemetry])
+    rolls = np.array([convert_to_float(data['roll']) for data in telemetry])
+    pitches = np.array([convert_to_float(data['pitch']) for data in telemetry])
+    picking_up = np.array([int(data['picking_up']) for data in telemetry])
+    level = ((rolls < 0.3) | (rolls > 359.7)) & ((pitches < 0.3) | (pitches > 359.7)) & (picking_up == 0)
+    return positions[:, 0], positions[:, 1], yaws, level
+
+# Define a function to classify a stack of frames (N x rows x cols x 3):
+# returns an N x rows x cols label stack (see TerrainClassifier)
+def classify_batch(frames, camera, classifier):
+    warped = np.empty(frames.shape, dtype=np.uint8)
+    for idx in range(len(frames)):
+        camera.warp(frames[idx], out=warped[idx])
+    # Pack the three channels of the whole stack into 24-bit table indices
+    index = warped[..., 0].astype(np.uint32)
+    index <<= 8
+    index |= warped[..., 1]
+    index <<= 8
+    index |= warped[..., 2]
+    labels = np.take(classifier.current_lut(), index)
+    labels *= camera.fov_mask
+    return labels
+
+# Define a function to project a label stack into the world map given one pose
+# per frame.  Returns the number of navigable, obstacle and rock pixels
+# observed in each (flat) map cell.  Every frame shares the same pixel grid, so
+# the field-of-view pixels are projected as one dense frames x pixels array and
+# counted per (cell, class) with a single bincount.  The map has resolution
+# cells per meter, as RoverState's.
+def batch_evidence(labels, xs, ys, yaws, camera, world_shape, resolution=1, scale=10):
+    size = world_shape[0] * world_shape[1]
+    fov = np.flatnonzero(camera.fov_mask)
+    classes = labels.reshape(len(labels), -1)[:, fov]
+    xpix = camera.x_table[fov].astype(np.float64)
+    ypix = camera.y_table[fov].astype(np.float64)
+    # Same rotation, translation and flooring as pix_to_cells(), one pose per row
+    cell_scale = float(scale) / resolution
+    yaw_rad = (yaws * np.pi / 180)[:, None]
+    cos_yaw = np.cos(yaw_rad)
+    sin_yaw = np.sin(yaw_rad)
+    x_cell = np.floor((xpix * cos_yaw - ypix * sin_yaw) / cell_scale + (xs * resolution)[:, None]).astype(np.int_)
+    y_cell = np.floor((xpix * sin_yaw + ypix * cos_yaw) / cell_scale + (ys * resolution)[:, None]).astype(np.int_)
+    # Pixels falling off the map are dropped, as in OccupancyGrid.cells()
+    inside = (x_cell >= 0) & (x_cell < world_shape[1]) & (y_cell >= 0) & (y_cell < world_shape[0])
+    keys = ((y_cell * world_shape[1] + x_cell) * 4 + classes)[inside]
+    counts = np.bincount(keys, minlength=size * 4).reshape(size, 4)
+    return counts[:, NAVIGABLE], counts[:, OBSTACLE], counts[:, ROCK]
+
+# Define a function to turn accumulated pixel counts into an occupancy grid
+def build_grid(nav, obstacle, rocks, world_shape, tile=TILE_METERS):
+    grid = OccupancyGrid(world_shape, tile)
+    evidence = LOGODDS_FREE * nav + LOGODDS_OCCUPIED * obstacle
+    # Only the observed cells are written, so only their tiles get allocated
+    cells = np.flatnonzero(evidence)
+    grid.logodds.put_flat(cells, np.clip(evidence[cells], -LOGODDS_LIMIT, LOGODDS_LIMIT))
+    cells = np.flatnonzero(rocks)
+    grid.rocks.put_flat(cells, np.minimum(rocks[cells], ROCK_LIMIT))
+    return grid
+
+# Camera model and classifier of a worker process, built on first use
+models = None
+
+# Define a function to map one chunk of a recorded run in batches.
+# Takes (run folder, chunk id, world shape, map resolution, batch size) so it
+# can run in a worker process; returns (frames mapped, frames skipped, nav, obstacle, rock counts).
+def chunk_evidence(job):
+    global models
+    path, chunk_id, world_shape, resolution, batch_size = job
+    if models is None:
+        models = (CameraModel(), TerrainClassifier())
+    camera, classifier = models
+    telemetry, frames = TelemetryReader(path).load_chunk(chunk_id)
+    size = world_shape[0] * world_shape[1]
+    totals = [np.zeros(size, dtype=np.int64) for idx in range(3)]
+    xs, ys, yaws, level = batch_poses(telemetry)
+    keep = np.flatnonzero(level)
+    for start in range(0, len(keep), batch_size):
+        batch = keep[start:start + batch_size]
+        labels = classify_batch(np.asarray(frames[batch]), camera, classifier)
+        counts = batch_evidence(labels, xs[batch], ys[batch], yaws[batch], camera, world_shape, resolution)
+        for total, count in zip(totals, counts):
+            total += count
+    return len(keep), len(telemetry) - len(keep), totals[0], totals[1], totals[2]
+
+# Define a function to build the map of a recorded run at map_resolution cells
+# per meter, spreading its chunks over the given number of processes.
+# Returns (grid, frames mapped, frames skipped).
+def map_run(path, map_resolution=1, processes=1, batch_size=64):
+    world_shape = (WORLD_SIZE * map_resolution, WORLD_SIZE * map_resolution)
+    reader = TelemetryReader(path)
+    jobs = [(path, chunk_id, world_shape, map_resolution, batch_size) for chunk_id in range(len(reader.chunks))]
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            results = pool.map(chunk_evidence, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [chunk_evidence(job) for job in jobs]
+    size = world_shape[0] * world_shape[1]
+    nav, obstacle, rocks = [np.zeros(size, dtype=np.int64) for idx in range(3)]
+    mapped = skipped = 0
+    for frames_mapped, frames_skipped, chunk_nav, chunk_obstacle, chunk_rocks in results:
+        mapped += frames_mapped
+        skipped += frames_skipped
+        nav += chunk_nav
+        obstacle += chunk_obstacle
+        rocks += chunk_rocks
+    return build_grid(nav, obstacle, rocks, world_shape, TILE_METERS * map_resolution), mapped, skipped
+
+# Define a function to report how well a map matches the ground truth and
+# how many of the known samples it located (grid at map_resolution cells per meter)
+def map_report(grid, ground_truth=None, samples_pos=None, map_resolution=1):
+    rock_counts = grid.rocks.dense()
+    navigable_cells, obstacle_cells = grid.cell_counts()
+    report = {'navigable_cells': navigable_cells, 'obstacle_cells': obstacle_cells,
+              'rock_cells': int((rock_counts > 0).sum())}
+    if ground_truth is not None:
+        truth = ground_truth[:,:,1] > 0
+        grid.set_ground_truth(truth.repeat(map_resolution, 0).repeat(map_resolution, 1))
+        # Same definitions as update_map_statistics()
+        report['perc_mapped'] = round(100. * grid.good_nav_count / max(grid.truth_count, 1), 1)
+        report['fidelity'] = round(100. * grid.good_nav_count / max(grid.nav_count, 1), 1)
+    if samples_pos is not None:
+        rocks = RockIndex()
+        rocks.set_samples(samples_pos)
+        rock_ys, rock_xs = np.nonzero(rock_counts)
+        # Rock samples are located in meters
+        rocks.add_detections((rock_xs + 0.5) / map_resolution, (rock_ys + 0.5) / map_resolution, 0)
+        report['samples_located'] = rocks.samples_located
+        report['samples_total'] = len(samples_pos[0])
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a world map and fidelity report from a recorded run')
+    parser.add_argument('run_folder', type=str, help='Recorded run (see drive_rover.py --record).')
+    parser.add_argument('--ground_truth', type=str, default='../calibration_images/map_bw.png',
+                        help='Ground truth map for the fidelity report ("" to skip).')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Worker processes.')
+    parser.add_argument('--map_resolution', type=int, default=1, help='Map cells per meter (as drive_rover.py).')
+    parser.add_argument('--batch', type=int, default=64, help='Frames classified and projected per batch.')
+    parser.add_argument('--output', type=str, default='', help='Save the map as an image.')
+    parser.add_argument('--report', type=str, default='', help='Save the report as JSON.')
+    args = parser.parse_args()
+
+    start = time.time()
+    grid, mapped, skipped = map_run(args.run_folder, args.map_resolution, processes=args.processes, batch_size=args.batch)
+    elapsed = time.time() - start
+
+    ground_truth = load_ground_truth(args.ground_truth) if args.ground_truth != '' else None
+    samples_pos = None
+    first = next(iter(TelemetryReader(args.run_folder)), None)
+    if first is not None and 'samples_x' in first[0]:
+        samples_pos = (np.int_([convert_to_float(pos.strip()) for pos in first[0]['samples_x'].split(';')]),
+                       np.int_([convert_to_float(pos.strip()) for pos in first[0]['samples_y'].split(';')]))
+    report = map_report(grid, ground_truth, samples_pos, args.map_resolution)
+    report.update({'frames_mapped': mapped, 'frames_skipped': skipped, 'seconds': round(elapsed, 2)})
+
+    print('Mapped {} frames ({} skipped) in {:.2f} s ({:.1f} frames/sec)'.format(
+        mapped, skipped, elapsed, (mapped + skipped) / max(elapsed, 1e-9)))
+    for key, value in report.items():
+        print('{}: {}'.format(key, value))
+    if args.output != '':
+        # Flip so that the y-axis points upward, as in the inset map
+        cv2.imwrite(args.output, cv2.cvtColor(np.flipud(grid.render()), cv2.COLOR_RGB2BGR))
+    if args.report != '':
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
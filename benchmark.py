@@ -0,0 +1,329 @@
+# Per-stage microbenchmarks for the telemetry hot path.
+# Each stage is driven over synthetic frames (or the frames of a recorded run)
+# and p50/p99 latency plus the memory allocated per call are reported.
+# Example: $ python benchmark.py --save bench_baseline.json
+#          $ python benchmark.py --compare bench_baseline.json
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+import eventlet
+
+from perception import perspect_transform, color_thresh, border_thresh, find_rocks, pix_to_world, perception_step, CameraModel, MAP_ENGINES
+from decision import decision_step
+from distance_field import DistanceField
+from rover_state import RoverState, load_ground_truth
+from supporting_functions import update_rover, create_output_images, update_map_statistics, encode_frame
+from telemetry_log import TelemetryReader
+from pipeline import FrameRunner, EXECUTION_MODES
+from inset_encoder import InsetEncoder
+from metrics import FrameMetrics, events
+
+# Define a function to synthesize a camera frame: a dark sky, sandy ground with
+# a ragged band of rock walls and, now and then, a yellow rock sample
+def synthetic_frame(rng, shape=(160, 320, 3)):
+    rows, cols = shape[0], shape[1]
+    frame = np.zeros(shape, dtype=np.uint8)
+    frame[:,:] = (60, 50, 40)
+    horizon = rows // 2 + rng.randint(-10, 10)
+    # Wall height varies along the image so the navigable area changes per frame
+    wall = horizon + (25*np.abs(np.sin(np.linspace(0, rng.uniform(1, 6), cols)))).astype(int)
+    ground = np.arange(rows)[:, None] > wall[None, :]
+    frame[ground] = (190, 170, 150)
+    if rng.random_sample() < 0.3:
+        center = (rng.randint(40, cols - 40), rng.randint(horizon + 30, rows - 10))
+        cv2.circle(frame, center, 4, (180, 150, 10), -1)
+    noisy = frame.astype(np.int16) + rng.randint(-20, 20, size=shape)
+    return np.clip(noisy, 0, 255).astype(np.uint8)
+
+# Define a function to build a telemetry dict as the simulator would send it
+def synthetic_telemetry(rng, frame):
+    return {'speed': str(rng.uniform(0, 2)), 'position': '{};{}'.format(rng.uniform(20, 180), rng.uniform(20, 180)),
+            'yaw': str(rng.uniform(0, 360)), 'pitch': str(rng.uniform(0, 0.2)), 'roll': str(rng.uniform(0, 0.2)),
+            'throttle': '0.2', 'steering_angle': '0', 'near_sample': '0', 'picking_up': '0',
+            'sample_count': '6', 'samples_x': '100;50;120;60;70;80', 'samples_y': '90;70;100;110;80;120',
+            'image': encode_frame(frame)}
+
+# Define a function to load the benchmark inputs: (telemetry dicts, RGB frames)
+def load_inputs(run_folder, n_frames, seed):
+    telemetry = []
+    frames = []
+    if run_folder != '':
+        for data, frame in TelemetryReader(run_folder):
+            frame = np.array(frame)
+            data = dict(data)
+            data['image'] = encode_frame(frame)
+            telemetry.append(data)
+            frames.append(frame)
+            if len(frames) >= n_frames:
+                break
+    else:
+        rng = np.random.RandomState(seed)
+        for idx in range(n_frames):
+            frame = synthetic_frame(rng)
+            telemetry.append(synthetic_telemetry(rng, frame))
+            frames.append(frame)
+    return telemetry, frames
+
+# Define a function to build the stages to benchmark, each a callable taking a frame index
+def build_stages(Rover, telemetry, frames):
+    camera = Rover.camera
+    warped = [camera.warp(frame) for frame in frames]
+    navigable = [camera.rover_coords(color_thresh(img) & camera.fov_mask) for img in warped]
+    # Distance-to-start field over a 100 x 100 cell known area, cut by a wall
+    # of obstacle cells which is closed and opened again every 10 frames (the
+    # repair is spread over the frames in between)
+    field = DistanceField(Rover.occupancy.shape)
+    field_logodds = np.zeros(Rover.occupancy.shape, dtype=np.int16)
+    field_logodds[50:150, 50:150] = -1
+    wall = 120 * Rover.occupancy.shape[1] + np.arange(50, 145)
+    field.set_goal(60, 60, field_logodds < 0)
+    while field.pending:
+        field.advance()
+    no_change = np.zeros(0, dtype=np.int64)
+
+    def run_update_rover(idx):
+        update_rover(Rover, telemetry[idx])
+
+    def run_perspect_transform(idx):
+        perspect_transform(frames[idx], camera.source, camera.destination)
+
+    def run_camera_warp(idx):
+        camera.warp(frames[idx])
+
+    def run_threshold_functions(idx):
+        color_thresh(warped[idx])
+        border_thresh(warped[idx])
+        find_rocks(warped[idx])
+
+    def run_classifier(idx):
+        Rover.classifier.classify(warped[idx], camera.fov_mask)
+
+    def run_pix_to_world(idx):
+        xpix, ypix = navigable[idx]
+        pix_to_world(xpix, ypix, Rover.pos[0], Rover.pos[1], Rover.yaw, Rover.occupancy.shape[0], 10)
+
+    def run_perception_step(idx):
+        Rover.img = frames[idx]
+        perception_step(Rover)
+
+    def run_distance_field(idx):
+        if idx % 10 == 0:
+            field_logodds.flat[wall] = 1 if idx % 20 == 0 else -1
+            field.update(wall, field_logodds)
+        else:
+            field.update(no_change, field_logodds)
+
+    def run_decision_step(idx):
+        decision_step(Rover)
+
+    def run_create_output_images(idx):
+        create_output_images(Rover)
+
+    return [('update_rover', run_update_rover),
+            ('perspect_transform', run_perspect_transform),
+            ('camera_warp', run_camera_warp),
+            ('threshold_functions', run_threshold_functions),
+            ('classifier', run_classifier),
+            ('pix_to_world', run_pix_to_world),
+            ('perception_step', run_perception_step),
+            ('distance_field', run_distance_field),
+            ('decision_step', run_decision_step),
+            ('create_output_images', run_create_output_images)]
+
+# Define a function to time a stage: returns per-call latencies in microseconds
+def time_stage(stage, n_frames, repeat):
+    latencies = []
+    for rep in range(repeat):
+        for idx in range(n_frames):
+            start = time.perf_counter()
+            stage(idx)
+            latencies.append((time.perf_counter() - start) * 1e6)
+    return np.array(latencies)
+
+# Define a function to measure the memory a stage allocates per call:
+# returns (mean peak KB above the starting point, mean KB still held after the call)
+def measure_allocations(stage, n_frames):
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    for idx in range(n_frames):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        stage(idx)
+        current, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - before)
+        retained.append(current - before)
+    tracemalloc.stop()
+    return np.mean(peaks) / 1024., np.mean(retained) / 1024.
+
+# Define a function to run all stages and collect the results
+def run_benchmarks(Rover, telemetry, frames, repeat):
+    # Warm up so one-off costs (lookup table builds, first decode) are not timed
+    stages = build_stages(Rover, telemetry, frames)
+    update_rover(Rover, telemetry[0])
+    for name, stage in stages:
+        stage(0)
+    results = {}
+    for name, stage in stages:
+        latencies = time_stage(stage, len(frames), repeat)
+        alloc_kb, retained_kb = measure_allocations(stage, len(frames))
+        results[name] = {'p50_us': round(float(np.percentile(latencies, 50)), 1),
+                         'p99_us': round(float(np.percentile(latencies, 99)), 1),
+                         'mean_us': round(float(latencies.mean()), 1),
+                         'alloc_kb': round(float(alloc_kb), 1),
+                         'retained_kb': round(float(retained_kb), 1)}
+    return results
+
+# Define a function to compare results against a saved baseline.
+# Returns the names of the stages whose p50 or p99 regressed beyond the tolerance.
+def compare_results(results, baseline, tolerance):
+    regressions = []
+    print('{:<22}{:>12}{:>12}{:>9}{:>12}{:>12}{:>9}'.format(
+        'stage', 'base p50', 'p50', 'ratio', 'base p99', 'p99', 'ratio'))
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        base = baseline[name]
+        ratio50 = stats['p50_us'] / max(base['p50_us'], 1e-9)
+        ratio99 = stats['p99_us'] / max(base['p99_us'], 1e-9)
+        flag = ''
+        if ratio50 > 1 + tolerance or ratio99 > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<22}{:>12}{:>12}{:>9.2f}{:>12}{:>12}{:>9.2f}{}'.format(
+            name, base['p50_us'], stats['p50_us'], ratio50, base['p99_us'], stats['p99_us'], ratio99, flag))
+    return regressions
+
+# Define a function to drive a FrameRunner like the simulator does: send a
+# frame, wait for the reply, spend sim_ms rendering the next frame.  Returns
+# (frames/sec, p50 and p99 reply latency in ms) for one execution mode.
+def run_execution_mode(ground_truth, telemetry, mode, sim_ms, repeat):
+    Rover = RoverState(ground_truth)
+    encoder = InsetEncoder()
+    runner = FrameRunner(Rover, FrameMetrics(), encoder, None, mode)
+    latencies = []
+
+    def simulate():
+        # Warm up once so the lookup table build is not timed
+        runner.step(telemetry[0])
+        start = time.perf_counter()
+        for rep in range(repeat):
+            for data in telemetry:
+                sent = time.perf_counter()
+                runner.step(data)
+                latencies.append((time.perf_counter() - sent) * 1000)
+                eventlet.sleep(sim_ms / 1000.)
+        runner.close()
+        return time.perf_counter() - start
+
+    elapsed = eventlet.spawn(simulate).wait()
+    encoder.close()
+    return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+# Define a function to compare the execution modes of the telemetry handler end to end
+def compare_execution_modes(ground_truth, telemetry, sim_ms, repeat):
+    quiet = events.quiet
+    events.quiet = True
+    results = {}
+    for mode in EXECUTION_MODES:
+        results[mode] = run_execution_mode(ground_truth, telemetry, mode, sim_ms, repeat)
+    events.quiet = quiet
+    print('{:<12}{:>14}{:>12}{:>12}'.format('execution', 'frames/sec', 'p50 ms', 'p99 ms'))
+    for mode, (fps, p50, p99) in results.items():
+        print('{:<12}{:>14.1f}{:>12.2f}{:>12.2f}'.format(mode, fps, p50, p99))
+    return results
+
+# Camera configurations compared by --camera_modes: (name, CameraModel options)
+CAMERA_MODES = [('full', {}),
+                ('roi', {'roi': True}),
+                ('roi/2', {'roi': True, 'downsample': 2}),
+                ('roi 80', {'roi': True, 'max_range': 80}),
+                ('roi/2 80', {'roi': True, 'downsample': 2, 'max_range': 80})]
+
+# Define a function to compare perception_step latency and map quality across
+# camera configurations.  Each one maps the frames from a fresh Rover, so on a
+# recorded run the mapped / fidelity figures show what the speed-up costs.
+def compare_camera_modes(ground_truth, telemetry, repeat, map_engine='scatter'):
+    quiet = events.quiet
+    events.quiet = True
+    results = {}
+    for name, options in CAMERA_MODES:
+        camera = CameraModel(**options)
+        Rover = RoverState(ground_truth, camera)
+        Rover.map_engine = map_engine
+        # Warm up so the lookup table build is not timed
+        update_rover(Rover, telemetry[0])
+        perception_step(Rover)
+        latencies = []
+        for rep in range(repeat):
+            for data in telemetry:
+                update_rover(Rover, data)
+                start = time.perf_counter()
+                perception_step(Rover)
+                latencies.append((time.perf_counter() - start) * 1e6)
+        update_map_statistics(Rover)
+        results[name] = (camera.fov_mask.size, int(camera.fov_mask.sum()), np.percentile(latencies, 50),
+                         np.percentile(latencies, 99), Rover.perc_mapped, Rover.fidelity)
+    events.quiet = quiet
+    print('{:<12}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('camera', 'pixels', 'in view', 'p50 us', 'p99 us',
+                                                            'mapped', 'fidelity'))
+    for name, (pixels, in_view, p50, p99, mapped, fidelity) in results.items():
+        print('{:<12}{:>10}{:>10}{:>10.1f}{:>10.1f}{:>10}{:>10}'.format(name, pixels, in_view, p50, p99, mapped, fidelity))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-stage benchmarks of the telemetry hot path')
+    parser.add_argument('--run_folder', type=str, default='', help='Benchmark on a recorded run instead of synthetic frames.')
+    parser.add_argument('--frames', type=int, default=50, help='Number of frames to use.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed passes over the frames.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic frames.')
+    parser.add_argument('--ground_truth', type=str, default='../calibration_images/map_bw.png',
+                        help='Ground truth map (an empty map is used if it does not exist).')
+    parser.add_argument('--save', type=str, default='', help='Save the results as a JSON baseline.')
+    parser.add_argument('--compare', type=str, default='', help='Compare the results against a JSON baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown before a stage counts as regressed.')
+    parser.add_argument('--execution', action='store_true',
+                        help='Compare the serial, offload and pipeline execution modes end to end instead.')
+    parser.add_argument('--sim_ms', type=float, default=20, help='Time the simulated simulator takes per frame (--execution).')
+    parser.add_argument('--camera_modes', action='store_true',
+                        help='Compare perception_step on the full frame against the cropped / downsampled camera instead.')
+    parser.add_argument('--map_engine', type=str, choices=MAP_ENGINES, default='scatter', help='Map engine used with --camera_modes.')
+    args = parser.parse_args()
+
+    if os.path.exists(args.ground_truth):
+        ground_truth = load_ground_truth(args.ground_truth)
+    else:
+        print('Ground truth {} not found, using an empty map'.format(args.ground_truth))
+        ground_truth = np.zeros((200, 200, 3))
+    telemetry, frames = load_inputs(args.run_folder, args.frames, args.seed)
+    if args.execution:
+        compare_execution_modes(ground_truth, telemetry, args.sim_ms, args.repeat)
+        sys.exit(0)
+    if args.camera_modes:
+        compare_camera_modes(ground_truth, telemetry, args.repeat, args.map_engine)
+        sys.exit(0)
+    Rover = RoverState(ground_truth)
+    results = run_benchmarks(Rover, telemetry, frames, args.repeat)
+
+    print('{:<22}{:>10}{:>10}{:>10}{:>12}{:>13}'.format('stage', 'p50 us', 'p99 us', 'mean us', 'alloc KB', 'retained KB'))
+    for name, stats in results.items():
+        print('{:<22}{:>10}{:>10}{:>10}{:>12}{:>13}'.format(
+            name, stats['p50_us'], stats['p99_us'], stats['mean_us'], stats['alloc_kb'], stats['retained_kb']))
+
+    report = {'source': args.run_folder if args.run_folder != '' else 'synthetic',
+              'frames': len(frames), 'repeat': args.repeat, 'stages': results}
+    if args.save != '':
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare != '':
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline['stages'], args.tolerance)
+        if len(regressions) > 0:
+            print('Regressed stages: ' + ', '.join(regressions))
+            sys.exit(1)
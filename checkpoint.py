@@ -0,0 +1,196 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from eventlet import tpool
+from numpy.lib.format import open_memmap
+
+from metrics import events
+
+# A checkpoint folder holds:
+#   checkpoint.json     -> map geometry, rover state and the map files to apply in order
+#   full_00000.npy      -> every allocated map tile
+#   delta_00001.npy     -> the tiles written since the previous file
+# Each map file is an N x (1 + 3*tile*tile) int32 array: the flat tile key
+# followed by the tile of each map layer (MAP_LAYERS).  The files are written
+# through a memory map and read back memory-mapped.
+MANIFEST_FILE = 'checkpoint.json'
+FULL_FILE = 'full_{:05d}.npy'
+DELTA_FILE = 'delta_{:05d}.npy'
+# Tiled map layers saved, in file order
+MAP_LAYERS = ('logodds', 'rocks', 'countermap')
+
+# Define a function to return the tiled map layers of a Rover (see MAP_LAYERS)
+def map_layers(Rover):
+    return [Rover.occupancy.logodds, Rover.occupancy.rocks, Rover.countermap]
+
+# Define a function to collect the rover state needed to carry on the mission
+# (the mission clock, the start position, the samples and the rocks found)
+def rover_record(Rover):
+    record = {'total_time': Rover.total_time, 'start_pos': Rover.start_pos,
+              'samples_to_find': Rover.samples_to_find, 'samples_pos': None,
+              'rocks': [[cluster.x, cluster.y, cluster.count, cluster.last_seen] for cluster in Rover.rocks.clusters]}
+    if Rover.samples_pos is not None:
+        record['samples_pos'] = [[int(pos) for pos in Rover.samples_pos[0]], [int(pos) for pos in Rover.samples_pos[1]]]
+    return record
+
+# Define a class to checkpoint the map of a Rover without slowing down the
+# telemetry handler.  snapshot() is called once per frame: at most every
+# interval seconds it copies the map tiles written since the last snapshot
+# (every tile every full_every snapshots) and queues them; a background thread
+# writes them out and updates the manifest.  If the thread is still writing,
+# the snapshot is put off and the tiles wait for the next one.
+class MapCheckpointer():
+    def __init__(self, path, interval=5.0, full_every=12):
+        self.path = path
+        self.interval = interval
+        self.full_every = full_every
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.manifest = None # Manifest of the last file written
+        self.sequence = 0
+        manifest_path = os.path.join(path, MANIFEST_FILE)
+        if os.path.exists(manifest_path):
+            # Carry on numbering after the files of the checkpoint being resumed,
+            # they are removed once the first full checkpoint replaces them
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            self.sequence = self.manifest['sequence'] + 1
+        self.snapshots = 0 # Snapshots taken
+        self.deferred = 0 # Snapshots put off because the writer was busy
+        self.last_time = time.time()
+        self.job = None
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.closed = False
+        self.worker = threading.Thread(target=self.work, name='checkpoint')
+        self.worker.daemon = True
+        self.worker.start()
+
+    # Called from the telemetry handler between frames
+    def snapshot(self, Rover, force=False):
+        now = time.time()
+        if not force and now - self.last_time < self.interval:
+            return
+        if self.job is not None:
+            self.deferred += 1
+            return
+        self.last_time = now
+        layers = map_layers(Rover)
+        full = self.snapshots % self.full_every == 0
+        # Tile keys of the layers written since the last snapshot (or all of them)
+        keys = [layer.allocated() if full else layer.take_unsaved() for layer in layers]
+        if full:
+            for layer in layers:
+                layer.take_unsaved()
+        keys = np.unique(np.concatenate(keys))
+        tile = layers[0].tile
+        records = np.empty((len(keys), 1 + len(layers) * tile * tile), dtype=np.int32)
+        records[:, 0] = keys
+        for idx, layer in enumerate(layers):
+            records[:, 1 + idx*tile*tile:1 + (idx + 1)*tile*tile] = layer.tiles(keys).reshape(len(keys), tile*tile)
+        manifest = {'map_shape': list(Rover.occupancy.shape), 'tile': tile,
+                    'map_resolution': Rover.map_resolution, 'time': now, 'rover': rover_record(Rover)}
+        self.snapshots += 1
+        with self.lock:
+            self.job = (full, records, manifest)
+            self.ready.notify_all()
+
+    def work(self):
+        while True:
+            with self.lock:
+                while self.job is None and not self.closed:
+                    self.ready.wait()
+                if self.job is None:
+                    return
+                full, records, manifest = self.job
+            self.write(full, records, manifest)
+            with self.lock:
+                self.job = None
+                self.ready.notify_all()
+
+    # Block until the queued job (if any) is written
+    def wait(self):
+        with self.lock:
+            while self.job is not None:
+                self.ready.wait()
+
+    # Write one map file and the manifest pointing at it
+    def write(self, full, records, manifest):
+        stale = []
+        files = [] if full else self.manifest['files']
+        # A delta with no tiles only refreshes the rover state in the manifest
+        if full or len(records) > 0:
+            name = (FULL_FILE if full else DELTA_FILE).format(self.sequence)
+            mapped = open_memmap(os.path.join(self.path, name), mode='w+', dtype=records.dtype, shape=records.shape)
+            mapped[:] = records
+            mapped.flush()
+            del mapped
+            files = files + [name]
+        if full and self.manifest is not None:
+            stale = self.manifest['files']
+        manifest['files'] = files
+        manifest['sequence'] = self.sequence
+        # Replace the manifest atomically so a crash leaves the previous one intact
+        manifest_path = os.path.join(self.path, MANIFEST_FILE)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(manifest_path + '.tmp', manifest_path)
+        self.manifest = manifest
+        self.sequence += 1
+        for name in stale:
+            os.remove(os.path.join(self.path, name))
+
+    # Take a last snapshot of the Rover (if given), wait for it to be written and stop.
+    # The waits run on eventlet's native thread pool so that, called from the
+    # telemetry handler, they don't hold up the other sessions.
+    def close(self, Rover=None):
+        if Rover is not None:
+            tpool.execute(self.wait)
+            self.snapshot(Rover, force=True)
+        with self.lock:
+            self.closed = True
+            self.ready.notify_all()
+        tpool.execute(self.worker.join)
+
+# Define a function to restore a Rover's map and mission state from a
+# checkpoint folder.  Returns False (and leaves the Rover alone) if there is
+# no checkpoint there or it was taken with a different map geometry.
+def restore_checkpoint(path, Rover):
+    manifest_path = os.path.join(path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return False
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    layers = map_layers(Rover)
+    tile = layers[0].tile
+    if tuple(manifest['map_shape']) != Rover.occupancy.shape or manifest['tile'] != tile:
+        events.log("Checkpoint in {} has a {} map, not resuming".format(path, manifest['map_shape']))
+        return False
+    for name in manifest['files']:
+        records = np.load(os.path.join(path, name), mmap_mode='r')
+        keys = np.asarray(records[:, 0], dtype=np.intp)
+        for idx, layer in enumerate(layers):
+            tiles = records[:, 1 + idx*tile*tile:1 + (idx + 1)*tile*tile].reshape(len(keys), tile, tile)
+            layer.put_tiles(keys, tiles.astype(layer.dtype))
+    for layer in layers:
+        layer.take_unsaved()
+    # Rebuild what is derived from the map: statistics and frontier (the
+    # distance-to-start field is rebuilt over the first frames)
+    Rover.occupancy.recount()
+    known = np.flatnonzero(Rover.occupancy.logodds.dense())
+    Rover.frontiers.update(known, Rover.occupancy.logodds)
+    record = manifest['rover']
+    Rover.start_pos = record['start_pos']
+    if record['samples_pos'] is not None:
+        # The mission clock keeps running from where it stopped
+        Rover.total_time = record['total_time']
+        Rover.start_time = time.time() - (record['total_time'] or 0)
+        Rover.samples_pos = (np.int_(record['samples_pos'][0]), np.int_(record['samples_pos'][1]))
+        Rover.rocks.set_samples(Rover.samples_pos)
+        Rover.samples_to_find = record['samples_to_find']
+    for x, y, count, last_seen in record['rocks']:
+        Rover.rocks.add_cluster(x, y, count, last_seen)
+    Rover.samples_located = Rover.rocks.samples_located
+    return True
@@ -1,6 +1,8 @@
 import numpy as np
 import sys
 
+from metrics import events
+
 
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
@@ -11,7 +13,7 @@ def decision_step(Rover):
     # improve on this decision tree to do a good job of navigating autonomously!
     
     # Check if the rover is stuck or not
-    if np.abs(Rover.vel_history).mean() <= 0.2:
+    if Rover.vel_history.mean() <= 0.2:
         index_stuck = Rover.frame_counter2 % 160
         # Do something and try to get rid of the stuck state
         if index_stuck <= 40:
@@ -35,7 +37,7 @@ def decision_step(Rover):
             if dist_to_start < 3:
                 Rover.brake = Rover.brake_set
                 Rover.throttle = 0
-                print('Mission Completed!')
+                events.log('Mission Completed!')
             else:
                 # Here, I just repeat the given code for mapping, the only change is that the steer direction is weighted
                 # toward the starting position.
@@ -98,31 +100,31 @@ def decision_step(Rover):
                     Rover.brake = 0
         # If there are still some rock samples to be collected, do the following.
         else:
-            # Check if a rock sample is found.
-            if (Rover.rock_angles is not None and len(Rover.rock_angles) >= Rover.toward_rock) or Rover.near_sample:
+            # Check if a rock sample is found (a tracked rock, see RockTracker).
+            if Rover.rock_target is not None or Rover.near_sample:
                 # If in a state where want to pickup a rock send pickup command
                 if Rover.near_sample and not Rover.picking_up:
                     Rover.mode = 'sample'
-                    # Reset rock status
-                    Rover.rock_angles = None
-                    Rover.rock_dists = 0
+                    # Stop tracking the rock being picked up
+                    Rover.rock_tracker.drop(Rover.rock_target)
                     Rover.throttle = 0
                     Rover.brake = Rover.brake_set
                     if Rover.vel == 0 and not Rover.picking_up:
                         Rover.send_pickup = True
-                elif np.mean(Rover.rock_dists) >= Rover.stop_dist_rock and Rover.near_sample == 0:
-                    Rover.steer = np.clip(np.mean(Rover.rock_angles * 180/np.pi), -15, 15)
-                    # Reset rock status
-                    Rover.rock_angles = None
+                elif Rover.near_sample == 0 and Rover.rock_dist >= Rover.stop_dist_rock:
+                    Rover.steer = np.clip(Rover.rock_angle, -15, 15)
+                    # Release the brake left on by a closer approach (the
+                    # tracked rock can be further away again after a turn)
+                    Rover.brake = 0
                     if Rover.vel < Rover.max_vel:
                         # Set throttle value to throttle setting
                         Rover.throttle = Rover.throttle_set
                     else: # Else coast
                         Rover.throttle = 0
                 # If the distance to the rock sample is not large, do this.
-                elif np.mean(Rover.rock_dists) < Rover.stop_dist_rock and Rover.near_sample == 0:
+                elif Rover.near_sample == 0 and Rover.rock_dist < Rover.stop_dist_rock:
                     Rover.mode = 'sample'
-                    if np.abs(Rover.steer-np.mean(Rover.rock_angles * 180/np.pi)) <= 1:
+                    if np.abs(Rover.steer-Rover.rock_angle) <= 1:
                         if Rover.vel > 1:
                             Rover.brake = Rover.brake_set
                             Rover.throttle = 0
@@ -136,9 +138,7 @@ def decision_step(Rover):
                         else:
                             Rover.throttle = 0
                             Rover.brake = 0
-                            Rover.steer = np.clip(np.mean(Rover.rock_angles * 180/np.pi), -15, 15)
-                    # Reset rock status
-                    Rover.rock_angles = None   
+                            Rover.steer = np.clip(Rover.rock_angle, -15, 15)
             # If no rock sample is found, just navigate and explore.
             else:
                 # Check if we have vision data to make decisions with
@@ -149,8 +149,9 @@ def decision_step(Rover):
                     elif Rover.mode == 'forward': 
                         # Check the extent of navigable terrain
                         if len(Rover.nav_angles) >= Rover.stop_forward:  
-                            # For every 3000 time steps, stop and do some turning for 100 frames
-                            if Rover.frame_counter3 >= 2900:
+                            # For every 3000 time steps, stop and do some turning for 100 frames,
+                            # unless there is a frontier left to head for
+                            if Rover.frame_counter3 >= 2900 and Rover.explore_heading is None:
                                 Rover.throttle = 0
                                 if Rover.vel > 0:
                                     Rover.brake = 0.1*Rover.brake_set
@@ -169,7 +170,7 @@ def decision_step(Rover):
                                 # Set steering to average angle clipped to the range +/- 15
                                 average_angle = (Rover.nav_weights * Rover.nav_angles * 180/np.pi).sum()
                                 bias_angle = 0.3*np.abs(average_angle)
-                                Rover.steer = np.clip(average_angle + bias_angle*np.random.normal(), -15, 15)
+                                Rover.steer = np.clip(average_angle + bias_angle*Rover.rng.normal(), -15, 15)
                         # If there's a lack of navigable terrain pixels then go to 'stop' mode
                         elif len(Rover.nav_angles) < Rover.stop_forward:
                                 # Set mode to "stop" and hit the brakes!
@@ -203,7 +204,7 @@ def decision_step(Rover):
                                 # Set steer to mean angle
                                 average_angle = (Rover.nav_weights * Rover.nav_angles * 180/np.pi).sum()
                                 bias_angle = 0.3*np.abs(average_angle)
-                                Rover.steer = np.clip(average_angle + bias_angle*np.random.normal(), -15, 15)
+                                Rover.steer = np.clip(average_angle + bias_angle*Rover.rng.normal(), -15, 15)
                                 Rover.mode = 'forward'
                 # Just to make the rover do something 
                 # even if no modifications have been made to the code
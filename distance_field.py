@@ -0,0 +1,213 @@
+import numpy as np
+
+from tiled_map import TiledArray, TILE_METERS
+
+# The 8 neighbours of a cell (dy, dx) and their step costs in map cells
+NEIGHBOR_DY = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+NEIGHBOR_DX = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+NEIGHBOR_COST = np.hypot(NEIGHBOR_DY, NEIGHBOR_DX)
+# Tolerance when checking whether a cell's distance was derived from a neighbour
+DIST_TOLERANCE = 1e-3
+# Cells settled or invalidated per update (a frame); the rest of the work is
+# carried over to the next updates.  A step (a front or bucket of cells) is
+# charged at least STEP_CELLS, about what its numpy overhead costs.
+MAX_CELLS_PER_UPDATE = 1000
+STEP_CELLS = 32
+
+# Define a class to hold the grid distance from every known navigable cell of
+# the world map to a goal cell (the rover's start position), measured along
+# 8-connected paths through navigable cells.  The field is updated
+# incrementally from the cells whose navigable state changed each frame, so
+# only the part of the field affected by those cells is recomputed.  Each
+# update does at most budget cells worth of work, a whole wavefront of cells
+# at a time with numpy; whatever is left over (a big area cut off by a new
+# wall, the first computation after a resume) carries on over the next frames,
+# the field lagging behind the map meanwhile.
+# The distances are float32 tiles (see TiledArray), so memory follows the
+# area explored.  Cells which are not navigable hold NaN (the fill), navigable
+# cells not reached (yet) hold inf.
+class DistanceField():
+    def __init__(self, shape=(200, 200), tile=TILE_METERS, budget=MAX_CELLS_PER_UPDATE):
+        self.shape = (shape[0], shape[1])
+        self.tile = tile
+        self.budget = budget
+        self.dist = TiledArray(self.shape, tile, np.float32, fill=np.nan)
+        self.goal = None # Goal cell (row, col)
+        # Work carried over between updates (flat cells): cells whose
+        # distance is being invalidated (with the distance they had), cells
+        # invalidated and waiting for their neighbours' best offer, and the
+        # open cells of the Dijkstra wavefront (with their distance)
+        self.stale_cells = np.zeros(0, dtype=np.int64)
+        self.stale_dist = np.zeros(0)
+        self.invalid = np.zeros(0, dtype=np.int64)
+        self.open_cells = np.zeros(0, dtype=np.int64)
+        self.open_dist = np.zeros(0)
+
+    # Whether some work is still carried over to the next update
+    @property
+    def pending(self):
+        return len(self.stale_cells) + len(self.invalid) + len(self.open_cells) > 0
+
+    # Set the goal to world position (x, y) and compute the field from scratch
+    # given a boolean map of the navigable cells
+    def set_goal(self, x, y, navigable):
+        row = min(max(int(y), 0), self.shape[0] - 1)
+        col = min(max(int(x), 0), self.shape[1] - 1)
+        self.goal = (row, col)
+        goal = np.array([row * self.shape[1] + col])
+        self.dist = TiledArray(self.shape, self.tile, np.float32, fill=np.nan)
+        self.dist.put_flat(np.flatnonzero(navigable), np.inf)
+        # The rover starts on navigable ground, whatever the map says so far
+        self.dist.put_flat(goal, 0.)
+        self.stale_cells = np.zeros(0, dtype=np.int64)
+        self.stale_dist = np.zeros(0)
+        self.invalid = np.zeros(0, dtype=np.int64)
+        self.open_cells = goal
+        self.open_dist = np.zeros(1)
+        self.advance()
+
+    # Return the neighbours inside the map of the flat cells as
+    # (position of the cell in cells, flat neighbour cell, step cost) arrays
+    def neighbors(self, cells):
+        rows, cols = np.divmod(cells, self.shape[1])
+        nrows = rows[:, None] + NEIGHBOR_DY
+        ncols = cols[:, None] + NEIGHBOR_DX
+        inside = (nrows >= 0) & (nrows < self.shape[0]) & (ncols >= 0) & (ncols < self.shape[1])
+        source, direction = np.nonzero(inside)
+        return source, nrows[inside] * self.shape[1] + ncols[inside], NEIGHBOR_COST[direction]
+
+    # Give the flat cells the best distance their neighbours offer (where it
+    # improves on theirs) and open them
+    def seed(self, cells):
+        source, neighbors, cost = self.neighbors(cells)
+        best = np.full(len(cells), np.inf)
+        # fmin skips the NaN offers of the neighbours which are not navigable
+        np.fmin.at(best, source, self.dist.take_flat(neighbors) + cost)
+        # (and a cell which is not navigable is never improved)
+        better = best < self.dist.take_flat(cells) - DIST_TOLERANCE
+        self.dist.put_flat(cells[better], best[better])
+        self.open_cells = np.concatenate((self.open_cells, cells[better]))
+        self.open_dist = np.concatenate((self.open_dist, best[better]))
+
+    # Queue the neighbours whose distance was derived through the flat cells,
+    # which had distances dists, for invalidation.  A neighbour is derived
+    # through a cell if it is no closer than the cell plus the step.  (Not
+    # just equal to it: a neighbour may still hold what it got from an older,
+    # higher distance of the cell, with the relaxation lowering it carried over.)
+    def queue_derived(self, cells, dists):
+        source, neighbors, cost = self.neighbors(cells)
+        neighbor_dist = self.dist.take_flat(neighbors)
+        derived = np.isfinite(neighbor_dist) & (neighbor_dist > dists[source] + cost - DIST_TOLERANCE)
+        self.stale_cells = np.concatenate((self.stale_cells, neighbors[derived]))
+        self.stale_dist = np.concatenate((self.stale_dist, neighbor_dist[derived]))
+
+    # Invalidate the current front of stale cells and move the front on to
+    # the neighbours derived through them.  Returns the number of entries
+    # taken off the front.
+    def invalidate_front(self):
+        cells, dists = self.stale_cells, self.stale_dist
+        self.stale_cells = np.zeros(0, dtype=np.int64)
+        self.stale_dist = np.zeros(0)
+        # Cells already invalidated, improved or blocked since are left alone
+        current = np.abs(self.dist.take_flat(cells) - dists) < DIST_TOLERANCE
+        front, first = np.unique(cells[current], return_index=True)
+        self.dist.put_flat(front, np.inf)
+        self.invalid = np.concatenate((self.invalid, front))
+        self.queue_derived(front, dists[current][first])
+        return len(cells)
+
+    # Settle the open cells within one cell of the nearest one and open the
+    # neighbours they improve.  Steps cost at least one cell, so no cell of
+    # the bucket can improve another and the whole bucket is settled at once
+    # (Dijkstra with buckets one cell wide).  Returns the number of entries
+    # taken off the wavefront.
+    def settle_bucket(self):
+        bucket = self.open_dist < self.open_dist.min() + 1
+        cells, dists = self.open_cells[bucket], self.open_dist[bucket]
+        self.open_cells, self.open_dist = self.open_cells[~bucket], self.open_dist[~bucket]
+        # Entries superseded since they were opened (or blocked) are skipped
+        current = np.abs(self.dist.take_flat(cells) - dists) < DIST_TOLERANCE
+        cells, dists = cells[current], dists[current]
+        source, neighbors, cost = self.neighbors(cells)
+        offers = dists[source] + cost
+        better = offers < self.dist.take_flat(neighbors) - DIST_TOLERANCE
+        neighbors, offers = neighbors[better], offers[better]
+        # Keep the best offer for each neighbour
+        order = np.lexsort((offers, neighbors))
+        neighbors, offers = neighbors[order], offers[order]
+        first = np.ones(len(neighbors), dtype=bool)
+        first[1:] = neighbors[1:] != neighbors[:-1]
+        neighbors, offers = neighbors[first], offers[first]
+        self.dist.put_flat(neighbors, offers)
+        self.open_cells = np.concatenate((self.open_cells, neighbors))
+        self.open_dist = np.concatenate((self.open_dist, offers))
+        return int(bucket.sum())
+
+    # Carry on with the pending work, up to budget cells: first invalidate
+    # what was derived through blocked cells, then re-seed the invalidated
+    # cells from their neighbours, then relax the wavefront
+    def advance(self):
+        work = 0
+        while len(self.stale_cells) > 0 and work < self.budget:
+            work += max(self.invalidate_front(), STEP_CELLS)
+        if len(self.stale_cells) == 0 and len(self.invalid) > 0 and work < self.budget:
+            invalid = self.invalid
+            self.invalid = np.zeros(0, dtype=np.int64)
+            self.seed(invalid)
+            work += max(len(invalid), STEP_CELLS)
+        while len(self.stale_cells) == 0 and len(self.open_cells) > 0 and work < self.budget:
+            work += max(self.settle_bucket(), STEP_CELLS)
+
+    # Update the field for the flat cell indices whose state changed, given the
+    # occupancy log-odds (navigable cells are the ones < 0), and carry on with
+    # the pending work
+    def update(self, changed, logodds):
+        if self.goal is None:
+            return
+        changed = changed[changed != self.goal[0] * self.shape[1] + self.goal[1]]
+        if len(changed) > 0:
+            rows, cols = np.unravel_index(changed, self.shape)
+            navigable = logodds[rows, cols] < 0
+            dists = self.dist.take_flat(changed)
+            was_navigable = ~np.isnan(dists)
+            gained = changed[navigable & ~was_navigable]
+            lost = ~navigable & was_navigable
+            # Cells which became blocked: invalidate every cell whose distance
+            # was derived through them, then let those cells pick the best
+            # remaining neighbour
+            self.dist.put_flat(changed[lost], np.nan)
+            reached = lost & np.isfinite(dists)
+            self.queue_derived(changed[reached], dists[reached])
+            # Cells which became navigable: take the best neighbour
+            self.dist.put_flat(gained, np.inf)
+            self.seed(gained)
+        self.advance()
+
+    # Return the world heading (degrees, counter-clockwise from +x) from (x, y)
+    # towards the cell reached by walking downhill for up to radius steps, each
+    # step to the lowest of the 8 neighbours, or None if the field offers no
+    # way downhill from here.  Only reached cells are stepped on, so the walk
+    # never crosses a wall towards a lower cell on the other side.
+    def descent_heading(self, x, y, radius=3):
+        if self.goal is None:
+            return None
+        row, col = int(y), int(x)
+        row0, col0 = max(row - radius, 0), max(col - radius, 0)
+        row1, col1 = min(row + radius + 1, self.shape[0]), min(col + radius + 1, self.shape[1])
+        if not (row0 <= row < row1 and col0 <= col < col1):
+            return None
+        window = self.dist.region(row0, row1, col0, col1)
+        window = np.where(np.isfinite(window), window, np.inf)
+        cell = (row - row0, col - col0)
+        for step in range(radius):
+            nrows = cell[0] + NEIGHBOR_DY
+            ncols = cell[1] + NEIGHBOR_DX
+            inside = (nrows >= 0) & (nrows < window.shape[0]) & (ncols >= 0) & (ncols < window.shape[1])
+            nrows, ncols = nrows[inside], ncols[inside]
+            lowest = np.argmin(window[nrows, ncols])
+            if not window[nrows[lowest], ncols[lowest]] < window[cell]:
+                break
+            cell = (nrows[lowest], ncols[lowest])
+        if cell == (row - row0, col - col0):
+            return None
+        return np.arctan2(cell[0] + row0 + 0.5 - y, cell[1] + col0 + 0.5 - x) * 180 / np.pi
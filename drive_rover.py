@@ -2,7 +2,6 @@
 import argparse
 import shutil
 import base64
-from datetime import datetime
 import os
 import cv2
 import numpy as np
@@ -18,181 +17,141 @@ import matplotlib.image as mpimg
 import time
 
 # Import functions for perception and decision making
-from perception import perception_step
+from perception import perception_step, MAP_ENGINES, CameraModel, TerrainClassifier
 from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from rover_state import RoverState, load_ground_truth
+from pipeline import FrameRunner, EXECUTION_MODES
+from telemetry_log import AsyncRecorder
+from inset_encoder import InsetEncoder
+from metrics import FrameMetrics, events
+from checkpoint import MapCheckpointer, restore_checkpoint
+from supporting_functions import update_map_statistics
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
 app = Flask(__name__)
 
 # Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        self.start_pos = None # To record the start posistion of navigation
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.vel = None # Current velocity
-        self.vel_history = 3*np.ones(160) # Last 160 velocities, used to check whether the rover is stuck or not.
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_weights = None # Weights when calculating the averaged navigation angle
-        self.return_weights = None # Weights when calculating the averaged navigation angle for the returning of the Rover
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.rock_angles = None # Angles of the rock pixels
-        self.rock_dists = None # Distances of rock pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.mode = 'forward' # Current mode (can be forward, stop or sample)
-        self.throttle_set = 0.4 # Throttle setting when accelerating
-        self.brake_set = 15 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.toward_rock = 1 # Threshold to move toward the rock sample
-        self.stop_dist_rock = 50 # Distance threshold to stop before a rock sample
-        self.stop_forward = 300 # Threshold to initiate stopping
-        self.go_forward = 1000 # Threshold to go forward again
-        self.max_vel = 3 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        # Keep records of how many times each position has been mapped.
-        self.countermap = np.ones((200, 200), dtype=np.float) 
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        self.frame_counter2 = 0 # Count the number of frames
-        self.frame_counter3 = 0 # Count the number of frames
-        self.sign_steer = 0 # Left or Right for the 15-turn.
-# Initialize our rover 
-Rover = RoverState()
-
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+ground_truth_3d = load_ground_truth('../calibration_images/map_bw.png')
+
+# Camera geometry and classifier lookup table are the same for every rover,
+# so all sessions share one copy
+camera = CameraModel()
+classifier = TerrainClassifier()
+
+# Folder the sessions record to, if any (see image_folder and --record)
+record_path = ''
+
+# Define a function to give each session its own file when several sessions
+# record: the first session uses path itself, the next ones path_1, path_2, ...
+def session_path(path, index):
+    if path == '' or index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, index, ext)
+
+# Define a class to hold the state of one simulator connection: its own rover,
+# per-frame metrics, inset encoder, optional recorder and the runner driving them
+class Session():
+    count = 0 # Sessions opened so far
+
+    def __init__(self, sid):
+        self.sid = sid
+        self.index = Session.count
+        Session.count += 1
+        seed = None if args.seed is None else args.seed + self.index
+        self.Rover = RoverState(ground_truth_3d, camera, classifier, args.map_resolution, seed)
+        self.Rover.map_engine = args.map_engine
+        self.Rover.inset_every = args.inset_every
+        self.Rover.inset_interval = args.inset_ms
+        # Per-frame metrics and sampled status logging (see --log_every, --log_ms, --metrics_file)
+        self.metrics = FrameMetrics(log_every=args.log_every, log_interval=args.log_ms / 1000.,
+                                    path=session_path(args.metrics_file, self.index), name=str(self.index))
+        # Background inset renderer (None renders the insets synchronously, see --sync_insets)
+        self.inset_encoder = None if args.sync_insets else InsetEncoder()
+        # Optional background recorder of the telemetry and frames
+        self.recorder = None
+        if record_path != '':
+            self.recorder = AsyncRecorder(session_path(record_path, self.index), queue_size=args.record_queue)
+        # Optional map checkpoints, restored first with --resume
+        self.checkpointer = None
+        if args.checkpoint != '':
+            path = session_path(args.checkpoint, self.index)
+            if args.resume and restore_checkpoint(path, self.Rover):
+                events.log("[{}] Resumed from {} ({:.0f} s into the mission, {}% mapped)".format(
+                    self.index, path, self.Rover.total_time or 0, update_map_statistics(self.Rover).perc_mapped))
+            self.checkpointer = MapCheckpointer(path, args.checkpoint_s, args.full_every)
+        self.runner = FrameRunner(self.Rover, self.metrics, self.inset_encoder, self.recorder, args.execution,
+                                  self.checkpointer)
+
+    def close(self):
+        self.runner.close()
+        self.metrics.close()
+        if self.inset_encoder is not None:
+            self.inset_encoder.close()
+        if self.checkpointer is not None:
+            self.checkpointer.close(self.Rover)
+        if self.recorder is not None:
+            self.recorder.close()
+            events.log("[{}] Recorded {} frames, dropped {}".format(
+                self.index, self.recorder.recorded, self.recorder.dropped))
+
+# Open sessions, keyed by socket id
+sessions = {}
+
+# Define a function to look up the session of a socket id (opening it if the
+# telemetry arrived before the connect event did)
+def get_session(sid):
+    if sid not in sessions:
+        sessions[sid] = Session(sid)
+    return sessions[sid]
 
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
 
-    global frame_counter, second_counter, fps
-    frame_counter+=1
-    # Do a rough calculation of frames per second (FPS)
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
-
     if data:
-        global Rover
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
-            
-            # Update frame counter 3
-            if Rover.frame_counter3 >= 3000:
-                Rover.frame_counter3 = 0
-            else:
-                Rover.frame_counter3 += 1
-            
-            # Get the sign of steering
-            if Rover.frame_counter3 == 2900:
-                Rover.sign_steer = np.sign(np.random.random() - 0.5)
-            
-            # Update frame counter 2
-            if Rover.frame_counter2 >= 159:
-                Rover.frame_counter2 = 0
-            else:
-                Rover.frame_counter2 += 1
-            
-            # Update velocity history
-            if Rover.mode == 'stop' or Rover.mode == 'sample':
-                Rover.vel_history[Rover.frame_counter2] = Rover.max_vel
-            else:
-                Rover.vel_history[Rover.frame_counter2] = Rover.vel
-
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-            
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
-
-            # The action step!  Send commands to the rover!
- 
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
-            else:
-                # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
-        else:
+        session = get_session(sid)
+        # Run perception and decision on this frame (how depends on --execution)
+        # and get back what to send to the simulator
+        pickup, commands, out_image_string1, out_image_string2 = session.runner.step(data)
 
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
+        # The action step!  Send commands to the rover!
 
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+        # Don't send both of these, they both trigger the simulator
+        # to send back new telemetry so we must only send one
+        # back in respose to the current telemetry data.
+
+        # If in a state where want to pickup a rock send pickup command
+        if pickup:
+            send_pickup(sid)
+        else:
+            # Send commands to the rover!
+            # (zeros for throttle, brake and steer and empty images in case of invalid telemetry)
+            send_control(commands, out_image_string1, out_image_string2, sid)
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, room=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
-    print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    events.log("connect {}".format(sid))
+    get_session(sid)
+    send_control((0, 0, 0), '', '', sid)
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        room=sid)
 
-def send_control(commands, image_string1, image_string2):
+@sio.on('disconnect')
+def disconnect(sid):
+    events.log("disconnect {}".format(sid))
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.close()
+
+def send_control(commands, image_string1, image_string2, sid):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -201,20 +160,20 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
-    # Send commands via socketIO server
+    # Send commands via socketIO server to the session they are for
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
-    print("Picking up")
+def send_pickup(sid):
+    events.log("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        room=sid)
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -223,24 +182,158 @@ if __name__ == '__main__':
         type=str,
         nargs='?',
         default='',
-        help='Path to image folder. This is where the images from the run will be saved.'
+        help='Path to image folder. This is where the frames and telemetry of the run will be recorded (chunked, see telemetry_log.py).'
+    )
+    parser.add_argument(
+        '--map_engine',
+        type=str,
+        choices=MAP_ENGINES,
+        default='scatter',
+        help='How classified pixels are written into the worldmap: per-pixel scatter or one raster warp per frame.'
+    )
+    parser.add_argument(
+        '--map_resolution',
+        type=int,
+        default=1,
+        help='World map cells per meter (the map is stored in tiles allocated as the rover explores).'
+    )
+    parser.add_argument(
+        '--roi',
+        action='store_true',
+        help='Warp and classify only the part of the top-down view inside the camera field of view (and --max_range).'
+    )
+    parser.add_argument(
+        '--downsample',
+        type=int,
+        default=1,
+        help='Warp and classify only every N-th row and column of the top-down view.'
+    )
+    parser.add_argument(
+        '--max_range',
+        type=float,
+        default=None,
+        help='Drop pixels further than this from the rover (in top-down view pixels, 10 per map cell) before mapping.'
+    )
+    parser.add_argument(
+        '--record',
+        type=str,
+        default='',
+        help='Folder to record raw telemetry and decoded frames to, for replay.py (one folder per session: run, run_1, ...).'
+    )
+    parser.add_argument(
+        '--record_queue',
+        type=int,
+        default=64,
+        help='Frames the recorder may queue before it starts dropping the oldest ones.'
+    )
+    parser.add_argument(
+        '--inset_every',
+        type=int,
+        default=1,
+        help='Re-render and encode the map and vision insets at most every N frames.'
+    )
+    parser.add_argument(
+        '--inset_ms',
+        type=float,
+        default=0,
+        help='Re-render and encode the map and vision insets at most every T milliseconds.'
+    )
+    parser.add_argument(
+        '--sync_insets',
+        action='store_true',
+        help='Render and encode the inset images in the telemetry handler instead of a background worker.'
+    )
+    parser.add_argument(
+        '--checkpoint',
+        type=str,
+        default='',
+        help='Folder to checkpoint the map and mission state to (one folder per session: ckpt, ckpt_1, ...).'
+    )
+    parser.add_argument(
+        '--checkpoint_s',
+        type=float,
+        default=5,
+        help='Seconds between checkpoints (each one only writes the map tiles changed since the last).'
+    )
+    parser.add_argument(
+        '--full_every',
+        type=int,
+        default=12,
+        help='Write every map tile, rather than the changed ones, every N checkpoints.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Restore the map and mission state from the --checkpoint folder at startup.'
+    )
+    parser.add_argument(
+        '--seed',
+        type=int,
+        default=None,
+        help='Seed the random choices of the decision step for repeatable runs (session N uses seed + N).'
+    )
+    parser.add_argument(
+        '--execution',
+        type=str,
+        choices=EXECUTION_MODES,
+        default='serial',
+        help='Run each frame on the eventlet hub (serial), on native threads (offload), or pipelined with one frame of control latency (pipeline).'
+    )
+    parser.add_argument(
+        '--log_every',
+        type=int,
+        default=0,
+        help='Print the status line at most every N frames (0 to rely on --log_ms only).'
+    )
+    parser.add_argument(
+        '--log_ms',
+        type=float,
+        default=1000,
+        help='Print the status line and repeated messages at most every T milliseconds.'
+    )
+    parser.add_argument(
+        '--quiet',
+        action='store_true',
+        help='Turn off all console output.'
+    )
+    parser.add_argument(
+        '--metrics_file',
+        type=str,
+        default='',
+        help='CSV file to write the per-frame metrics to (flushed every 256 frames, one file per session: m.csv, m_1.csv, ...).'
     )
     args = parser.parse_args()
+    events.quiet = args.quiet
+    if args.roi or args.downsample > 1 or args.max_range is not None:
+        camera = CameraModel(roi=args.roi, downsample=args.downsample, max_range=args.max_range)
+    events.interval = args.log_ms / 1000.
+    if args.image_folder != '' and args.record != '':
+        parser.error('Give either image_folder or --record, not both')
+    if args.resume and args.checkpoint == '':
+        parser.error('--resume needs the --checkpoint folder to resume from')
+    if args.record != '':
+        events.log("Recording telemetry to {}".format(args.record))
+        record_path = args.record
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
-        print("Creating image folder at {}".format(args.image_folder))
+        events.log("Creating image folder at {}".format(args.image_folder))
         if not os.path.exists(args.image_folder):
             os.makedirs(args.image_folder)
         else:
             shutil.rmtree(args.image_folder)
             os.makedirs(args.image_folder)
-        print("Recording this run ...")
-    else:
-        print("NOT recording this run ...")
+        events.log("Recording this run ...")
+        record_path = args.image_folder
+    elif record_path == '':
+        events.log("NOT recording this run ...")
     
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        for session in list(sessions.values()):
+            session.close()
@@ -0,0 +1,82 @@
+import numpy as np
+
+from tiled_map import TiledArray, TILE_METERS
+
+# The 8 neighbours of a cell (dy, dx)
+NEIGHBOR_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+# Side of the coarse blocks the frontier cells are clustered into (map cells)
+FRONTIER_BLOCK = 10
+# Blocks holding fewer frontier cells than this are treated as noise
+MIN_FRONTIER_CELLS = 4
+# Score bonus of the block currently targeted, keeps the rover from dithering between targets
+TARGET_STICKINESS = 1.5
+# Spread (degrees) of the bias of the navigation weights towards the target heading,
+# and the weight left to pixels facing away from it
+TARGET_SPREAD = 30.
+TARGET_FLOOR = 0.2
+
+# Define a class to keep an index of the exploration frontier: the known
+# navigable cells of the world map which border unknown cells.  The index is
+# updated from the cells whose state changed each frame (only they and their
+# neighbours can enter or leave the frontier), and frontier cells are counted
+# in coarse blocks so picking a target only looks at the block grid.  The
+# cell layers are tiled (see TiledArray), so memory follows the area explored.
+class FrontierIndex():
+    def __init__(self, shape=(200, 200), block=FRONTIER_BLOCK, tile=TILE_METERS):
+        self.shape = (shape[0], shape[1])
+        self.block = block
+        self.unknown = TiledArray(self.shape, tile, bool, fill=True) # Unknown cells
+        self.frontier = TiledArray(self.shape, tile, bool, fill=False)
+        blocks = (-(-self.shape[0] // block), -(-self.shape[1] // block))
+        self.counts = np.zeros(blocks, dtype=np.int32) # Frontier cells per block
+        self.sum_x = np.zeros(blocks, dtype=np.float64) # Sums of their x and y, for the block centroids
+        self.sum_y = np.zeros(blocks, dtype=np.float64)
+        self.target = None # Block (row, col) currently targeted
+
+    # Update the index for the flat cell indices whose state changed, given the occupancy log-odds
+    def update(self, changed, logodds):
+        if len(changed) == 0:
+            return
+        rows, cols = np.unravel_index(changed, self.shape)
+        self.unknown.put(rows, cols, logodds[rows, cols] == 0)
+        # The changed cells and their neighbours may enter or leave the frontier
+        rows = np.concatenate([rows] + [rows + dy for dy, dx in NEIGHBOR_OFFSETS])
+        cols = np.concatenate([cols] + [cols + dx for dy, dx in NEIGHBOR_OFFSETS])
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        cells = np.unique(rows[inside] * self.shape[1] + cols[inside])
+        rows, cols = np.unravel_index(cells, self.shape)
+        borders_unknown = np.zeros(len(cells), dtype=bool)
+        for dy, dx in NEIGHBOR_OFFSETS:
+            # Off the map counts as known (read as fill, so masked out)
+            nrows = rows + dy
+            ncols = cols + dx
+            borders_unknown |= self.unknown[nrows, ncols] & self.unknown.inside(nrows, ncols)
+        now = (logodds[rows, cols] < 0) & borders_unknown
+        delta = now.astype(np.int32) - self.frontier[rows, cols]
+        moved = delta != 0
+        if not moved.any():
+            return
+        rows, cols, delta = rows[moved], cols[moved], delta[moved]
+        self.frontier.put(rows, cols, delta > 0)
+        block_rows = rows // self.block
+        block_cols = cols // self.block
+        np.add.at(self.counts, (block_rows, block_cols), delta)
+        np.add.at(self.sum_x, (block_rows, block_cols), delta * (cols + 0.5))
+        np.add.at(self.sum_y, (block_rows, block_cols), delta * (rows + 0.5))
+
+    # Return the world heading (degrees, counter-clockwise from +x) from (x, y)
+    # towards the best frontier cluster, or None if no frontier is left.  Big
+    # clusters close to the rover score best.
+    def target_heading(self, x, y):
+        valid = self.counts >= MIN_FRONTIER_CELLS
+        if not valid.any():
+            self.target = None
+            return None
+        counts = np.maximum(self.counts, 1)
+        cx = self.sum_x / counts
+        cy = self.sum_y / counts
+        score = np.where(valid, self.counts / (np.hypot(cx - x, cy - y) + self.block), 0)
+        if self.target is not None and valid[self.target]:
+            score[self.target] *= TARGET_STICKINESS
+        self.target = np.unravel_index(np.argmax(score), score.shape)
+        return np.arctan2(cy[self.target] - y, cx[self.target] - x) * 180 / np.pi
@@ -0,0 +1,334 @@
+# Headless stand-in for the Unity simulator, to run whole missions against
+# drive_rover.py faster than real time (integration tests, throughput runs).
+# The world is the ground truth map: navigable cells are sand, the rest are
+# walls, and rock samples are placed along the walls.  The rover follows a
+# simple kinematic model stepped by a fixed simulated time per frame, and its
+# camera frames are rendered through the inverse of the camera's perspective
+# transform.  It talks the simulator's socket.io protocol: it sends
+# 'telemetry', the server answers with 'data' (commands) or 'pickup', and
+# every answer triggers the next frame.  Start the server first
+# ($ python drive_rover.py --quiet), then
+# Example: $ python headless_sim.py --frames 6000
+# or, with the control stack run in this process instead of over the socket,
+# Example: $ python headless_sim.py --in_process --frames 6000
+import argparse
+import threading
+import time
+import cv2
+import numpy as np
+
+from perception import CameraModel, OUT_OF_VIEW, NAVIGABLE, OBSTACLE, ROCK
+from rover_state import RoverState, load_ground_truth
+from pipeline import FrameRunner, EXECUTION_MODES
+from metrics import FrameMetrics
+from supporting_functions import convert_to_float, encode_frame
+
+# Colour of each class in the rendered frames, chosen to classify as
+# TerrainClassifier does (out of view pixels are the sky)
+SIM_COLORS = np.uint8([[45, 45, 60], [200, 185, 165], [110, 85, 65], [190, 160, 20]])
+# Cells per meter of the world raster the frames are rendered from
+RENDER_RESOLUTION = 10
+# Rover-centric pixels (10 per meter) beyond which the camera sees only sky
+RENDER_RANGE = 500
+# Rover model
+THROTTLE_ACCEL = 5. # Acceleration per unit of throttle (m/s^2)
+BRAKE_DECEL = 1. # Deceleration per unit of brake (m/s^2)
+DRAG = 0.5 # Fraction of the speed lost per second when coasting
+MAX_SPEED = 5. # m/s
+WHEELBASE = 2. # Turning radius is WHEELBASE / tan(steer) (meters)
+SPIN_RATE = 3. # Yaw rate per degree of steer when turning in place (degrees/second)
+# Rock samples
+ROCK_RADIUS = 0.4 # meters
+NEAR_SAMPLE = 1. # Distance to a sample within which it can be picked up (meters)
+PICKUP_TIME = 2. # Simulated seconds a pickup takes
+SAMPLE_SPACING = 10. # Least distance between samples, and from the start (meters)
+# Start pose of the Unity simulator
+SIM_START = (99.7, 85.6)
+
+# Define a function to place rock samples on navigable cells next to a wall,
+# as the simulator does.  Returns an n x 2 array of (x, y) positions.
+def place_samples(navigable, n, rng, start, spacing=SAMPLE_SPACING):
+    walls = cv2.dilate((~navigable).astype(np.uint8), np.ones((3, 3), dtype=np.uint8)) > 0
+    ys, xs = np.nonzero(navigable & walls)
+    samples = []
+    for idx in rng.permutation(len(xs)):
+        x, y = xs[idx] + 0.5, ys[idx] + 0.5
+        if np.hypot(x - start[0], y - start[1]) < spacing:
+            continue
+        if any(np.hypot(x - other[0], y - other[1]) < spacing for other in samples):
+            continue
+        samples.append((x, y))
+        if len(samples) == n:
+            break
+    return np.array(samples).reshape(-1, 2)
+
+# Define a function to build the class raster (RENDER_RESOLUTION cells per
+# meter) the ground in the frames is rendered from
+def world_raster(navigable, resolution=RENDER_RESOLUTION):
+    classes = np.where(navigable, NAVIGABLE, OBSTACLE).astype(np.uint8)
+    return np.ascontiguousarray(classes.repeat(resolution, 0).repeat(resolution, 1))
+
+# Define a class to simulate one rover in the ground truth world.
+# control() / pickup() take the server's answer, step() advances the
+# simulation by dt seconds and telemetry() returns the next frame to send.
+class HeadlessSim():
+    def __init__(self, ground_truth, camera=None, n_samples=6, start=None, yaw=None, dt=0.05, seed=0):
+        rng = np.random.RandomState(seed)
+        self.navigable = ground_truth[:,:,1] > 0
+        self.dt = dt
+        if start is None:
+            start = SIM_START
+            if not self.drivable(*start):
+                ys, xs = np.nonzero(self.navigable)
+                idx = rng.randint(len(xs))
+                start = (xs[idx] + 0.5, ys[idx] + 0.5)
+        # Rover state
+        self.x, self.y = start
+        self.yaw = rng.uniform(0, 360) if yaw is None else yaw
+        self.speed = 0.
+        self.throttle = 0.
+        self.brake = 0.
+        self.steer = 0.
+        self.pickup_left = 0. # Simulated seconds left of the pickup in progress
+        # Rock samples (the telemetry always lists where they started)
+        self.samples = place_samples(self.navigable, n_samples, rng, start)
+        self.remaining = np.ones(len(self.samples), dtype=bool)
+        self.samples_x = ';'.join(str(x) for x in self.samples[:, 0])
+        self.samples_y = ';'.join(str(y) for y in self.samples[:, 1])
+        self.raster = world_raster(self.navigable)
+        # Rover-centric coords of the ground seen by every camera pixel
+        camera = camera if camera is not None else CameraModel()
+        self.init_camera(camera)
+        # Counters
+        self.time = 0.
+        self.frames = 0
+        self.distance = 0.
+        self.blocked = 0 # Frames the rover was stopped by a wall
+
+    # Work out which ground point (rover-centric pixels) every camera pixel
+    # sees, through the perspective transform of the camera model
+    def init_camera(self, camera):
+        rows, cols = camera.shape
+        us, vs = np.meshgrid(np.arange(cols, dtype=np.float64), np.arange(rows, dtype=np.float64))
+        M = camera.M
+        w = M[2,0]*us + M[2,1]*vs + M[2,2]
+        # The ground is on the side of the horizon the rover's own pixels are
+        w_ground = M[2,0]*camera.source[0,0] + M[2,1]*camera.source[0,1] + M[2,2]
+        ground = w*np.sign(w_ground) > 1e-9
+        w[~ground] = 1
+        x_rover = rows - (M[1,0]*us + M[1,1]*vs + M[1,2]) / w
+        y_rover = cols/2 - (M[0,0]*us + M[0,1]*vs + M[0,2]) / w
+        ground &= (x_rover > 0) & (np.sqrt(x_rover**2 + y_rover**2) < RENDER_RANGE)
+        self.shape = (rows, cols)
+        self.Minv = np.linalg.inv(M)
+        # Top-down pixels in view share the sign of w of the calibration square
+        self.view_sign = np.sign(self.Minv[2].dot([camera.destination[0,0], camera.destination[0,1], 1]))
+        self.pixels = np.flatnonzero(ground)
+        self.x_rover = x_rover.ravel()[self.pixels].astype(np.float32)
+        self.y_rover = y_rover.ravel()[self.pixels].astype(np.float32)
+        self.frame = np.empty((rows, cols, 3), dtype=np.uint8)
+        self.frame[:,:] = SIM_COLORS[OUT_OF_VIEW]
+
+    def drivable(self, x, y):
+        col, row = int(np.floor(x)), int(np.floor(y))
+        return 0 <= row < self.navigable.shape[0] and 0 <= col < self.navigable.shape[1] and self.navigable[row, col]
+
+    # Render the camera frame at the current pose (a reused buffer)
+    def render(self):
+        yaw_rad = self.yaw * np.pi / 180
+        scale = RENDER_RESOLUTION / 10.
+        cols = (self.x * RENDER_RESOLUTION + (self.x_rover * np.cos(yaw_rad) - self.y_rover * np.sin(yaw_rad)) * scale).astype(np.intp)
+        rows = (self.y * RENDER_RESOLUTION + (self.x_rover * np.sin(yaw_rad) + self.y_rover * np.cos(yaw_rad)) * scale).astype(np.intp)
+        # Off the map is all wall
+        inside = (rows.astype(np.uintp) < self.raster.shape[0]) & (cols.astype(np.uintp) < self.raster.shape[1])
+        classes = np.full(len(rows), OBSTACLE, dtype=np.uint8)
+        classes[inside] = self.raster[rows[inside], cols[inside]]
+        self.frame.reshape(-1, 3)[self.pixels] = SIM_COLORS[classes]
+        self.render_samples()
+        return self.frame
+
+    # Draw the samples left as upright discs standing on the ground (flat ones
+    # would be too foreshortened to see from more than a few meters)
+    def render_samples(self):
+        rows, cols = self.shape
+        yaw_rad = self.yaw * np.pi / 180
+        for x, y in self.samples[self.remaining]:
+            # Rover-centric coords, then top-down view pixel, of the sample
+            dx, dy = (x - self.x) * 10, (y - self.y) * 10
+            x_rover = dx * np.cos(yaw_rad) + dy * np.sin(yaw_rad)
+            y_rover = -dx * np.sin(yaw_rad) + dy * np.cos(yaw_rad)
+            if x_rover <= 0 or np.hypot(x_rover, y_rover) >= RENDER_RANGE:
+                continue
+            top = np.array([[cols/2 - y_rover - ROCK_RADIUS*10, cols/2 - y_rover + ROCK_RADIUS*10],
+                            [rows - x_rover, rows - x_rover], [1, 1]])
+            image = self.Minv.dot(top)
+            if (image[2] * self.view_sign <= 1e-9).any():
+                continue
+            us, vs = image[0] / image[2], image[1] / image[2]
+            radius = max(int(round(abs(us[1] - us[0]) / 2)), 1)
+            center = (int(round(us.mean())), int(round(vs.mean())) - radius)
+            cv2.circle(self.frame, center, radius, SIM_COLORS[ROCK].tolist(), -1)
+
+    # Index of the sample the rover can pick up, or None
+    def near_sample(self):
+        dists = np.hypot(self.samples[:, 0] - self.x, self.samples[:, 1] - self.y)
+        dists[~self.remaining] = np.inf
+        if len(dists) == 0 or dists.min() > NEAR_SAMPLE:
+            return None
+        return int(np.argmin(dists))
+
+    # Build the telemetry dict of the current state, as the simulator sends it
+    def telemetry(self):
+        return {'speed': str(self.speed), 'position': '{};{}'.format(self.x, self.y),
+                'yaw': str(self.yaw), 'pitch': '0', 'roll': '0',
+                'throttle': str(self.throttle), 'steering_angle': str(self.steer),
+                'near_sample': '0' if self.near_sample() is None else '1',
+                'picking_up': '1' if self.pickup_left > 0 else '0',
+                'sample_count': str(int(self.remaining.sum())),
+                'samples_x': self.samples_x, 'samples_y': self.samples_y,
+                'image': encode_frame(self.render())}
+
+    def control(self, throttle, brake, steer):
+        self.throttle = throttle
+        self.brake = brake
+        self.steer = np.clip(steer, -15, 15)
+
+    def pickup(self):
+        if self.pickup_left == 0 and self.near_sample() is not None:
+            self.pickup_left = PICKUP_TIME
+
+    # Advance the simulation by one frame
+    def step(self):
+        dt = self.dt
+        self.time += dt
+        self.frames += 1
+        if self.pickup_left > 0:
+            self.speed = 0.
+            self.pickup_left = max(self.pickup_left - dt, 0.)
+            if self.pickup_left == 0:
+                sample = self.near_sample()
+                if sample is not None:
+                    self.remaining[sample] = False
+            return
+        speed = self.speed + THROTTLE_ACCEL * self.throttle * dt
+        speed -= DRAG * speed * dt
+        if self.brake > 0:
+            speed -= np.sign(speed) * min(abs(speed), BRAKE_DECEL * self.brake * dt)
+        elif self.throttle == 0 and abs(speed) < 0.05:
+            speed = 0.
+        speed = float(np.clip(speed, -MAX_SPEED, MAX_SPEED))
+        # Stopped with the brake off, the rover turns in place on its four wheels
+        if speed == 0 and self.throttle == 0 and self.brake == 0:
+            self.yaw += SPIN_RATE * self.steer * dt
+        else:
+            self.yaw += speed * dt * np.tan(self.steer * np.pi / 180) / WHEELBASE * 180 / np.pi
+        self.yaw %= 360
+        yaw_rad = self.yaw * np.pi / 180
+        x = self.x + speed * dt * np.cos(yaw_rad)
+        y = self.y + speed * dt * np.sin(yaw_rad)
+        if self.drivable(x, y):
+            self.x, self.y = x, y
+            self.distance += abs(speed) * dt
+            self.speed = speed
+        else:
+            self.speed = 0.
+            self.blocked += 1
+
+    # Summary of the run so far
+    def report(self):
+        return {'frames': self.frames, 'sim_seconds': round(self.time, 1), 'distance_m': round(self.distance, 1),
+                'blocked_frames': self.blocked, 'samples_collected': int((~self.remaining).sum()),
+                'samples_total': len(self.samples)}
+
+# Define a class to drive a HeadlessSim from a control server over socket.io
+class SimClient():
+    def __init__(self, url, sim, frames):
+        self.url = url
+        self.sim = sim
+        self.frames = frames
+        self.done = threading.Event()
+        # Only this client needs the socket.io stack, the simulator and
+        # run_in_process() (see sweep.py) do without it
+        import socketio
+        self.sio = socketio.Client()
+        self.sio.on('data', self.on_data)
+        self.sio.on('pickup', self.on_pickup)
+        self.sio.on('get_samples', self.on_get_samples)
+
+    # The server answers the connection with a 'data' message, which starts the exchange
+    def run(self):
+        self.sio.connect(self.url)
+        self.done.wait()
+        self.sio.disconnect()
+
+    def on_data(self, data):
+        self.sim.control(convert_to_float(data['throttle']), convert_to_float(data['brake']),
+                         convert_to_float(data['steering_angle']))
+        self.next_frame()
+
+    def on_pickup(self, data):
+        self.sim.pickup()
+        self.next_frame()
+
+    # The server asks for the sample positions on connect: answer with where
+    # the samples started, as the telemetry lists them
+    def on_get_samples(self, data):
+        self.sio.emit('samples', {'samples_x': self.sim.samples_x, 'samples_y': self.sim.samples_y})
+
+    def next_frame(self):
+        if self.done.is_set():
+            return
+        if self.sim.frames >= self.frames:
+            self.done.set()
+            return
+        self.sim.step()
+        self.sio.emit('telemetry', self.sim.telemetry())
+
+# Define a function to drive a HeadlessSim with the control stack run in this
+# process (no server, no socket).  Returns the Rover.
+def run_in_process(sim, frames, ground_truth, execution='serial', map_engine='scatter', seed=None):
+    Rover = RoverState(ground_truth, seed=seed)
+    Rover.map_engine = map_engine
+    runner = FrameRunner(Rover, FrameMetrics(), mode=execution)
+    while sim.frames < frames:
+        pickup, commands, image1, image2 = runner.step(sim.telemetry())
+        if pickup:
+            sim.pickup()
+        else:
+            sim.control(*commands)
+        sim.step()
+    runner.close()
+    return Rover
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulator for the control server')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='Control server to connect to.')
+    parser.add_argument('--ground_truth', type=str, default='../calibration_images/map_bw.png', help='World map.')
+    parser.add_argument('--frames', type=int, default=6000, help='Frames to simulate.')
+    parser.add_argument('--dt', type=float, default=0.05, help='Simulated seconds per frame.')
+    parser.add_argument('--samples', type=int, default=6, help='Rock samples to place.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the sample positions, the start pose if not given and, with --in_process, the decision step.')
+    parser.add_argument('--start', type=float, nargs=3, default=None, help='Start pose: x y yaw.')
+    parser.add_argument('--in_process', action='store_true', help='Run the control stack in this process instead of connecting to a server.')
+    parser.add_argument('--execution', type=str, choices=EXECUTION_MODES, default='serial', help='Execution mode with --in_process.')
+    args = parser.parse_args()
+
+    ground_truth = load_ground_truth(args.ground_truth)
+    start, yaw = (None, None) if args.start is None else (args.start[:2], args.start[2])
+    sim = HeadlessSim(ground_truth, n_samples=args.samples, start=start, yaw=yaw, dt=args.dt, seed=args.seed)
+
+    begin = time.time()
+    Rover = None
+    if args.in_process:
+        Rover = run_in_process(sim, args.frames, ground_truth, args.execution, seed=args.seed)
+    else:
+        SimClient(args.url, sim, args.frames).run()
+    elapsed = time.time() - begin
+
+    report = sim.report()
+    report.update({'wall_seconds': round(elapsed, 2), 'frames_per_sec': round(sim.frames / max(elapsed, 1e-9), 1),
+                   'realtime_factor': round(sim.time / max(elapsed, 1e-9), 1)})
+    if Rover is not None:
+        report.update({'perc_mapped': Rover.perc_mapped, 'fidelity': Rover.fidelity})
+    for key, value in report.items():
+        print('{}: {}'.format(key, value))
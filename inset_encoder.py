@@ -0,0 +1,55 @@
+import time
+import threading
+import queue
+
+from supporting_functions import update_map_statistics, inset_due, snapshot_output_state, render_output_images
+
+# Define a class to render and JPEG-encode the inset images off the eventlet hub.
+# submit() hands a snapshot of the Rover to a native worker thread and returns
+# straight away; images always holds the most recently finished pair, so
+# control commands never wait for the encoding.  (drive_rover.py does not
+# monkey-patch threading, so the worker is a real OS thread and cv2/PIL release
+# the GIL while they work.)
+class InsetEncoder():
+    def __init__(self):
+        self.images = ('', '') # Last finished pair of encoded inset images
+        self.busy = False # A render is in flight
+        self.rendered = 0 # Number of renders finished
+        self.skipped = 0 # Frames where a render was due but the worker was still busy
+        self.jobs = queue.Queue(maxsize=1)
+        self.worker = threading.Thread(target=self.work, name='inset-encoder')
+        self.worker.daemon = True
+        self.worker.start()
+
+    # Called once per frame from the telemetry handler, returns the latest insets
+    def submit(self, Rover):
+        # Statistics are cheap to keep current every frame
+        update_map_statistics(Rover)
+        if not inset_due(Rover):
+            return self.images
+        if self.busy:
+            self.skipped += 1
+            return self.images
+        Rover.inset_counter = 0
+        Rover.inset_time = time.time()
+        self.busy = True
+        self.jobs.put_nowait((Rover, snapshot_output_state(Rover)))
+        return self.images
+
+    # Stop the worker once the render in flight (if any) is done
+    def close(self):
+        self.jobs.put(None)
+        self.worker.join()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            Rover, snapshot = job
+            try:
+                self.images = render_output_images(snapshot)
+                Rover.inset_images = self.images
+                self.rendered += 1
+            finally:
+                self.busy = False
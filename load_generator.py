@@ -0,0 +1,83 @@
+# Stub simulator clients to load-test drive_rover.py with several sessions.
+# Each client behaves like the simulator: it sends a telemetry frame, waits
+# for the reply ('data' or 'pickup') and sends the next one.  Start the
+# server first ($ python drive_rover.py --quiet), then
+# Example: $ python load_generator.py --sessions 1 2 4 8 --duration 10
+import argparse
+import time
+import numpy as np
+import socketio
+
+from benchmark import synthetic_frame, synthetic_telemetry
+
+# Define a class for one stub client
+class StubClient():
+    def __init__(self, url, telemetry):
+        self.url = url
+        self.telemetry = telemetry
+        self.replies = 0
+        self.latencies = []
+        self.sent_time = None
+        self.running = False
+        self.sio = socketio.Client()
+        self.sio.on('data', self.on_reply)
+        self.sio.on('pickup', self.on_reply)
+
+    # The server answers the connection with a 'data' message, which starts the exchange
+    def start(self):
+        self.running = True
+        self.sio.connect(self.url)
+
+    def on_reply(self, data):
+        if not self.running:
+            return
+        if self.sent_time is not None:
+            self.latencies.append((time.perf_counter() - self.sent_time) * 1000)
+            self.replies += 1
+        self.sent_time = time.perf_counter()
+        self.sio.emit('telemetry', self.telemetry[self.replies % len(self.telemetry)])
+
+    def stop(self):
+        self.running = False
+        self.sio.disconnect()
+
+# Define a function to drive the server with n_sessions clients for duration
+# seconds, returns (total frames/sec, frames/sec per session, p50 and p99 reply latency in ms)
+def run_load(url, n_sessions, duration, telemetry):
+    clients = [StubClient(url, telemetry) for idx in range(n_sessions)]
+    for client in clients:
+        client.start()
+    # Let the sessions warm up (classifier table, first renders) before counting
+    time.sleep(1)
+    start_replies = [client.replies for client in clients]
+    start_latencies = [len(client.latencies) for client in clients]
+    start = time.time()
+    time.sleep(duration)
+    elapsed = time.time() - start
+    replies = [client.replies - count for client, count in zip(clients, start_replies)]
+    latencies = np.concatenate([client.latencies[count:] for client, count in zip(clients, start_latencies)] + [[]])
+    for client in clients:
+        client.stop()
+    total = sum(replies) / elapsed
+    if len(latencies) == 0:
+        return total, 0, 0, 0
+    return total, total / n_sessions, np.percentile(latencies, 50), np.percentile(latencies, 99)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load generator for the multi-session control server')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='Control server to connect to.')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 2, 4, 8], help='Numbers of concurrent sessions to try.')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to measure each number of sessions for.')
+    parser.add_argument('--frames', type=int, default=50, help='Number of distinct synthetic frames the clients cycle through.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic frames.')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(args.seed)
+    telemetry = [synthetic_telemetry(rng, synthetic_frame(rng)) for idx in range(args.frames)]
+
+    print('{:>9}{:>14}{:>16}{:>12}{:>12}'.format('sessions', 'frames/sec', 'per session', 'p50 ms', 'p99 ms'))
+    for n_sessions in args.sessions:
+        total, per_session, p50, p99 = run_load(args.url, n_sessions, args.duration, telemetry)
+        print('{:>9}{:>14.1f}{:>16.1f}{:>12.2f}{:>12.2f}'.format(n_sessions, total, per_session, p50, p99))
+        # Give the server a moment to close the sessions
+        time.sleep(1)
@@ -0,0 +1,148 @@
+import time
+import numpy as np
+
+# Columns of the per-frame records
+METRIC_FIELDS = ['frame', 'time', 't_update_ms', 't_perception_ms', 't_decision_ms', 't_output_ms',
+                 'mode', 'vel', 'throttle', 'brake', 'steer', 'x', 'y', 'yaw',
+                 'nav_pixels', 'rock_pixels', 'perc_mapped', 'fidelity',
+                 'samples_located', 'samples_collected']
+# Rover modes are stored as numeric codes
+MODES = ['forward', 'stop', 'sample']
+# The stages timed in the telemetry handler, in order
+STAGES = ['t_update_ms', 't_perception_ms', 't_decision_ms', 't_output_ms']
+
+# Define a class to print console messages with sampling and rate limiting.
+# Each distinct message is printed at most once per interval seconds, and
+# nothing is printed at all when quiet is set.
+class EventLog():
+    def __init__(self, interval=1.0, quiet=False):
+        self.interval = interval
+        self.quiet = quiet
+        self.last_printed = {} # message -> time it was last printed
+
+    def log(self, message):
+        if self.quiet:
+            return
+        now = time.time()
+        if now - self.last_printed.get(message, -np.inf) < self.interval:
+            return
+        self.last_printed[message] = now
+        print(message)
+
+# Shared console for messages raised outside the telemetry handler (e.g. decision_step)
+events = EventLog()
+
+# Define a class to keep per-frame metrics in a fixed size ring buffer.
+# A frame is begun with begin(), each stage is closed with lap(), and
+# end_frame() fills in the Rover state, prints a sampled status line and
+# appends the records to a CSV file every flush_every frames.
+class FrameMetrics():
+    def __init__(self, capacity=1024, log_every=0, log_interval=1.0, path='', flush_every=256, name=''):
+        self.name = name # Prefix of the status lines, tells sessions apart
+        self.records = np.zeros((capacity, len(METRIC_FIELDS)))
+        self.columns = dict((name, idx) for idx, name in enumerate(METRIC_FIELDS))
+        self.count = 0 # Number of frames recorded so far
+        self.flushed = 0 # Number of frames written to the CSV file so far
+        self.log_every = log_every # Print a status line every N frames (0: rate limited only)
+        self.log_interval = log_interval # and at most every T seconds
+        self.last_log = 0
+        self.path = path
+        self.flush_every = min(flush_every, capacity)
+        self.formats = ['%.3f' if name == 'time' else '%.6g' for name in METRIC_FIELDS]
+        self.row = np.zeros(len(METRIC_FIELDS))
+        self.lap_time = 0
+        self.stage = 0
+        if path != '':
+            with open(path, 'w') as f:
+                f.write(','.join(METRIC_FIELDS) + '\n')
+
+    # Start timing a new frame
+    def begin(self):
+        self.row[:] = 0
+        self.row[self.columns['time']] = time.time()
+        self.stage = 0
+        self.lap_time = time.perf_counter()
+
+    # Close the next stage of the frame (see STAGES).  Pass the Rover when
+    # closing the perception stage to record its pixel counts.
+    def lap(self, Rover=None):
+        now = time.perf_counter()
+        self.row[self.columns[STAGES[self.stage]]] = (now - self.lap_time) * 1000
+        self.stage += 1
+        self.lap_time = now
+        if Rover is not None:
+            self.row[self.columns['nav_pixels']] = len(Rover.nav_angles) if Rover.nav_angles is not None else 0
+            self.row[self.columns['rock_pixels']] = Rover.rock_tracker.pixels
+
+    # Record the Rover state at the end of a frame
+    def end_frame(self, Rover):
+        row = self.row
+        columns = self.columns
+        row[columns['frame']] = self.count
+        row[columns['mode']] = MODES.index(Rover.mode) if Rover.mode in MODES else -1
+        row[columns['vel']] = Rover.vel
+        row[columns['throttle']] = Rover.throttle
+        row[columns['brake']] = Rover.brake
+        row[columns['steer']] = Rover.steer
+        row[columns['x']] = Rover.pos[0]
+        row[columns['y']] = Rover.pos[1]
+        row[columns['yaw']] = Rover.yaw
+        row[columns['perc_mapped']] = Rover.perc_mapped
+        row[columns['fidelity']] = Rover.fidelity
+        row[columns['samples_located']] = Rover.samples_located
+        row[columns['samples_collected']] = Rover.samples_collected
+        self.records[self.count % len(self.records)] = row
+        self.count += 1
+        if self.path != '' and self.count - self.flushed >= self.flush_every:
+            self.flush()
+        if not events.quiet and self.log_due(row[columns['time']]):
+            print(self.status())
+
+    def log_due(self, now):
+        if self.log_every > 0 and self.count % self.log_every != 0:
+            return False
+        if now - self.last_log < self.log_interval:
+            return False
+        self.last_log = now
+        return True
+
+    # Return the last n records (oldest first)
+    def last(self, n=None):
+        n = min(self.count, len(self.records)) if n is None else min(n, self.count, len(self.records))
+        idx = np.arange(self.count - n, self.count) % len(self.records)
+        return self.records[idx]
+
+    # Frames per second over the last second of records
+    def fps(self):
+        if self.count == 0:
+            return 0
+        times = self.last()[:, self.columns['time']]
+        return int((times > times[-1] - 1).sum())
+
+    # One-line summary of the latest frame
+    def status(self):
+        row = self.last(1)[0]
+        columns = self.columns
+        mode = int(row[columns['mode']])
+        prefix = '[{}] '.format(self.name) if self.name != '' else ''
+        return prefix + ('frame {:.0f} fps {} mode {} vel {:.2f} steer {:.1f} nav {:.0f} rock {:.0f} '
+                'mapped {:.1f}% fidelity {:.1f}% located {:.0f} collected {:.0f} '
+                'perception {:.2f}ms decision {:.2f}ms output {:.2f}ms').format(
+                row[columns['frame']], self.fps(), MODES[mode] if mode >= 0 else '?',
+                row[columns['vel']], row[columns['steer']], row[columns['nav_pixels']],
+                row[columns['rock_pixels']], row[columns['perc_mapped']], row[columns['fidelity']],
+                row[columns['samples_located']], row[columns['samples_collected']],
+                row[columns['t_perception_ms']], row[columns['t_decision_ms']], row[columns['t_output_ms']])
+
+    # Append the records not yet written to the CSV file
+    def flush(self):
+        if self.path == '' or self.count == self.flushed:
+            return
+        # Records overwritten in the ring before they could be flushed are lost
+        pending = self.last(self.count - self.flushed)
+        with open(self.path, 'a') as f:
+            np.savetxt(f, pending, delimiter=',', fmt=self.formats)
+        self.flushed = self.count
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,163 @@
+import cv2
+import numpy as np
+
+from tiled_map import TiledArray, TILE_METERS
+
+# Log-odds evidence added for every pixel observed as navigable / obstacle.
+# Navigable evidence is stronger so that, as with the old overwrite order,
+# a cell seen as both in the same frame leans towards navigable.
+LOGODDS_FREE = -2
+LOGODDS_OCCUPIED = 1
+# Saturation limit of the log-odds, keeps cells able to change their mind
+LOGODDS_LIMIT = 1000
+# Saturation limit of the rock observation counts
+ROCK_LIMIT = 1000
+# Brightness per unit of log-odds when rendering the map for display
+RENDER_GAIN = 8
+
+# Define a class to hold the world map as an integer log-odds occupancy grid.
+# Every observation is accumulated into the grid rather than overwriting it,
+# so a single noisy frame cannot erase what earlier frames have seen.  The
+# grid is stored in tiles allocated as the rover explores (see TiledArray),
+# and the tiles changed since the last render are tracked so the display
+# only re-renders those.
+class OccupancyGrid():
+    def __init__(self, shape=(200, 200), tile=TILE_METERS):
+        self.shape = (shape[0], shape[1])
+        self.size = shape[0] * shape[1]
+        # Log-odds of each cell being an obstacle: > 0 obstacle, < 0 navigable, 0 unknown
+        self.logodds = TiledArray(self.shape, tile, np.int16)
+        # Number of rock sample pixels observed in each cell
+        self.rocks = TiledArray(self.shape, tile, np.int16)
+        # Flat indices of the cells whose state (unknown / navigable / obstacle)
+        # changed in the last update
+        self.changed = np.zeros(0, dtype=np.int64)
+        # Map statistics, maintained incrementally from the changed cells
+        self.truth = None # Flat ground truth navigable mask (see set_ground_truth())
+        self.truth_count = 0 # Number of ground truth navigable cells
+        self.nav_count = 0 # Number of cells currently believed navigable
+        self.good_nav_count = 0 # Number of those which are navigable in the ground truth
+
+    # Set the ground truth navigable mask used for the map statistics
+    def set_ground_truth(self, truth_mask):
+        self.truth = np.ascontiguousarray(truth_mask, dtype=bool).reshape(-1)
+        self.truth_count = int(self.truth.sum())
+        self.recount()
+
+    # Recount the navigable cells from scratch (after the grid was set wholesale)
+    def recount(self):
+        navigable = self.navigable().reshape(-1)
+        self.nav_count = int(navigable.sum())
+        if self.truth is not None:
+            self.good_nav_count = int((navigable & self.truth).sum())
+
+    # Return the flat indices of the cells (x, y) (int arrays), dropping the
+    # ones which fall off the map
+    def cells(self, x, y):
+        inside = (x >= 0) & (x < self.shape[1]) & (y >= 0) & (y < self.shape[0])
+        return y[inside] * self.shape[1] + x[inside]
+
+    # Forget the changes of the previous update (called once per frame)
+    def clear_changes(self):
+        self.changed = np.zeros(0, dtype=np.int64)
+
+    # Update the changed cells and the statistics given the old and new log-odds of some cells
+    def track_changes(self, cells, old_values, new_values):
+        changed = np.sign(old_values) != np.sign(new_values)
+        self.changed = cells[changed]
+        if len(self.changed) == 0:
+            return
+        was_nav = old_values[changed] < 0
+        now_nav = new_values[changed] < 0
+        gained = self.changed[now_nav & ~was_nav]
+        lost = self.changed[was_nav & ~now_nav]
+        self.nav_count += len(gained) - len(lost)
+        if self.truth is not None:
+            self.good_nav_count += int(self.truth[gained].sum()) - int(self.truth[lost].sum())
+
+    # Add per-cell evidence (int array) to the given flat cell indices
+    def add_evidence(self, cells, evidence):
+        old_values = self.logodds.take_flat(cells)
+        new_values = np.clip(old_values + evidence, -LOGODDS_LIMIT, LOGODDS_LIMIT)
+        self.logodds.put_flat(cells, new_values)
+        self.track_changes(cells, old_values, new_values)
+
+    # Accumulate one frame of per-pixel observations (flat cell index of each pixel)
+    def add_pixels(self, nav_cells, obstacle_cells, rock_cells=None):
+        if len(nav_cells) + len(obstacle_cells) > 0:
+            # Count over the span of cells the frame touched, not the whole map
+            first = min(nav_cells.min() if len(nav_cells) else self.size,
+                        obstacle_cells.min() if len(obstacle_cells) else self.size)
+            last = max(nav_cells.max() if len(nav_cells) else 0,
+                       obstacle_cells.max() if len(obstacle_cells) else 0)
+            span = last - first + 1
+            evidence = LOGODDS_FREE * np.bincount(nav_cells - first, minlength=span)
+            evidence += LOGODDS_OCCUPIED * np.bincount(obstacle_cells - first, minlength=span)
+            cells = np.flatnonzero(evidence)
+            self.add_evidence(cells + first, evidence[cells])
+        if rock_cells is not None and len(rock_cells) > 0:
+            cells, counts = np.unique(rock_cells, return_counts=True)
+            self.rocks.put_flat(cells, np.minimum(self.rocks.take_flat(cells) + counts, ROCK_LIMIT))
+
+    # Accumulate one frame of observations over the patch starting at (y0, x0).
+    # nav, obstacle and rocks hold the number of pixels seen in each cell.
+    def add_patch(self, y0, x0, nav, obstacle, rocks):
+        y1 = y0 + nav.shape[0]
+        x1 = x0 + nav.shape[1]
+        evidence = LOGODDS_FREE * nav.astype(np.int32) + LOGODDS_OCCUPIED * obstacle.astype(np.int32)
+        # Only the cells which received evidence can change
+        rows, cols = np.nonzero(evidence)
+        cells = (rows + y0) * self.shape[1] + (cols + x0)
+        self.add_evidence(cells, evidence[rows, cols])
+        if rocks.any():
+            region = self.rocks.region(y0, y1, x0, x1)
+            self.rocks.put_region(y0, x0, np.minimum(region + rocks.astype(np.int32), ROCK_LIMIT))
+
+    # Boolean maps of the cells currently believed navigable / obstacles
+    def navigable(self):
+        return self.logodds.dense() < 0
+
+    def obstacles(self):
+        return self.logodds.dense() > 0
+
+    # Number of cells believed navigable and obstacles, counted over the allocated tiles only
+    def cell_counts(self):
+        tiles = self.logodds.store[1:self.logodds.count]
+        return int((tiles < 0).sum()), int((tiles > 0).sum())
+
+    # Return the tiles (tile row, tile col) changed since the last call
+    def take_dirty(self):
+        dirty = np.argwhere(self.logodds.dirty | self.rocks.dirty)
+        self.logodds.clear_dirty()
+        self.rocks.clear_dirty()
+        return dirty
+
+    # Render the grid as an RGB image (obstacles red, rocks green, navigable
+    # terrain blue) with brightness given by the confidence of each cell.
+    # Only the given tiles are drawn (by default every allocated tile), so a
+    # persistent display image can be kept up to date from take_dirty().  out
+    # may be smaller than the grid by a whole factor (cells per pixel).
+    def render(self, out=None, tiles=None):
+        if out is None:
+            out = np.zeros(self.shape + (3,), dtype=np.uint8)
+        step = self.shape[0] // out.shape[0]
+        tile = self.logodds.tile
+        if tiles is None:
+            tiles = np.argwhere((self.logodds.index > 0) | (self.rocks.index > 0))
+        for tile_row, tile_col in tiles:
+            y0 = tile_row * tile
+            x0 = tile_col * tile
+            y1 = min(y0 + tile, self.shape[0])
+            x1 = min(x0 + tile, self.shape[1])
+            # Unallocated tiles are all fill (the store's slot 0)
+            logodds = self.logodds.store[self.logodds.index[tile_row, tile_col], :y1 - y0, :x1 - x0]
+            rocks = self.rocks.store[self.rocks.index[tile_row, tile_col], :y1 - y0, :x1 - x0]
+            gained = logodds.astype(np.int32) * RENDER_GAIN
+            rgb = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+            rgb[:,:,0] = np.clip(gained, 0, 255)
+            rgb[:,:,1] = np.where(rocks > 0, 255, 0)
+            rgb[:,:,2] = np.clip(-gained, 0, 255)
+            if step > 1:
+                rgb = cv2.resize(rgb, ((x1 - x0) // step, (y1 - y0) // step), interpolation=cv2.INTER_AREA)
+            out[y0 // step:y1 // step, x0 // step:x1 // step] = rgb
+        return out
@@ -1,6 +1,10 @@
+import threading
 import numpy as np
 import cv2
 
+from exploration import TARGET_SPREAD, TARGET_FLOOR
+from rock_tracker import rock_blobs
+
 # Identify pixels above the threshold
 # Threshold of RGB > 160 does a nice job of identifying ground pixels only
 def color_thresh(img, rgb_thresh=(160, 160, 160)):
@@ -106,90 +110,428 @@ def perspect_transform(img, src, dst):
     return warped
 
 
+# Define a class to hold the fixed camera geometry.  The camera never moves with
+# respect to the rover, so the perspective matrix, the remap tables and the
+# field-of-view mask are computed once at startup and reused for every frame.
+# Optionally only part of the warped view is produced:
+#   roi        -> only the bounding box of the pixels in view (and in range)
+#   downsample -> only every n-th row and column of it, each output pixel then
+#                 stands for n x n warped pixels (see pixel_area)
+#   max_range  -> pixels further than this (in rover-centric pixels) count as
+#                 out of view, the far field is both blurred and unreliable
+class CameraModel():
+    def __init__(self, img_shape=(160, 320), dst_size=5, bottom_offset=6, source=None, dtype=np.float32,
+                 roi=False, downsample=1, max_range=None):
+        rows, cols = img_shape[0], img_shape[1]
+        self.shape = (rows, cols)
+        # Source and destination points for the perspective transform
+        if source is None:
+            source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+        destination = np.float32([[cols/2 - dst_size, rows - bottom_offset],
+                          [cols/2 + dst_size, rows - bottom_offset],
+                          [cols/2 + dst_size, rows - 2*dst_size - bottom_offset], 
+                          [cols/2 - dst_size, rows - 2*dst_size - bottom_offset],
+                          ])
+        self.source = np.float32(source)
+        self.destination = destination
+        # Homography from the camera image to the top-down view
+        self.M = cv2.getPerspectiveTransform(self.source, self.destination)
+        # For every pixel of the warped image find the camera pixel it samples
+        xs, ys = np.meshgrid(np.arange(cols, dtype=np.float32), np.arange(rows, dtype=np.float32))
+        Minv = np.linalg.inv(self.M)
+        w = Minv[2,0]*xs + Minv[2,1]*ys + Minv[2,2]
+        # Rows at or beyond the horizon have no valid source pixel, they are
+        # the ones where w does not share the sign of the rover's own position
+        w_rover = Minv[2,0]*cols/2 + Minv[2,1]*(rows - bottom_offset) + Minv[2,2]
+        behind = w*np.sign(w_rover) <= 1e-9
+        w[behind] = 1
+        map_x = ((Minv[0,0]*xs + Minv[0,1]*ys + Minv[0,2]) / w).astype(np.float32)
+        map_y = ((Minv[1,0]*xs + Minv[1,1]*ys + Minv[1,2]) / w).astype(np.float32)
+        map_x[behind] = -1
+        map_y[behind] = -1
+        # Warped pixels which sample outside the camera image are out of view
+        # (they get the [0,255,255] border colour and must not count as obstacles)
+        fov_mask = (map_x >= 0) & (map_x < cols - 1) & (map_y >= 0) & (map_y < rows - 1)
+        # Rover-centric coordinates of every warped pixel, with the same
+        # conventions as rover_coords()
+        x_rover = rows - ys.astype(np.float64)
+        y_rover = cols/2 - xs.astype(np.float64)
+        dist = np.sqrt(x_rover**2 + y_rover**2)
+        self.max_range = max_range
+        if max_range is not None:
+            fov_mask &= dist <= max_range
+        # Part of the warped view actually produced: rows r0:r1 and columns c0:c1,
+        # every downsample-th pixel of them
+        r0, r1, c0, c1 = 0, rows, 0, cols
+        if roi and fov_mask.any():
+            in_rows = np.flatnonzero(fov_mask.any(axis=1))
+            in_cols = np.flatnonzero(fov_mask.any(axis=0))
+            r0, r1, c0, c1 = int(in_rows[0]), int(in_rows[-1]) + 1, int(in_cols[0]), int(in_cols[-1]) + 1
+        self.roi = (r0, r1, c0, c1)
+        self.downsample = downsample
+        self.pixel_area = downsample**2
+        self.full_frame = self.roi == (0, rows, 0, cols) and downsample == 1
+        grid = np.ix_(np.arange(r0, r1, downsample), np.arange(c0, c1, downsample))
+        self.fov_mask = fov_mask[grid]
+        # Fixed-point maps are the fastest input format for cv2.remap
+        self.map1, self.map2 = cv2.convertMaps(map_x[grid], map_y[grid], cv2.CV_16SC2)
+        # Rover-centric coordinates and polar coordinates of every output pixel,
+        # with the same conventions as rover_coords() and to_polar_coords().
+        # They stay in full resolution pixels whatever the downsample factor.
+        # float32 is plenty for steering and halves the memory traffic.
+        self.dtype = dtype
+        x_rover = x_rover[grid]
+        y_rover = y_rover[grid]
+        self.x_table = x_rover.astype(dtype).ravel()
+        self.y_table = y_rover.astype(dtype).ravel()
+        self.dist_table = dist[grid].astype(dtype).ravel()
+        self.angle_table = np.arctan2(y_rover, x_rover).astype(dtype).ravel()
+        # Affine transform taking output pixels (column, row) to rover coords (x, y)
+        self.rover_affine = np.array([[0., -downsample, rows - r0], [-downsample, 0., cols/2 - c0]])
+
+    # Warp a camera frame to the top-down view using the precomputed tables
+    def warp(self, img, out=None):
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR, dst=out,
+                         borderMode=cv2.BORDER_CONSTANT, borderValue=[0,255,255])
+
+    # Look up the rover-centric coords of the pixels set in a binary image
+    def rover_coords(self, binary_img):
+        idx = np.flatnonzero(binary_img)
+        return self.x_table.take(idx), self.y_table.take(idx)
+
+    # Look up rover-centric coords, distances and angles of the pixels set in a binary image
+    def polar_coords(self, binary_img):
+        idx = np.flatnonzero(binary_img)
+        return self.x_table.take(idx), self.y_table.take(idx), self.dist_table.take(idx), self.angle_table.take(idx)
+
+    # Paint an image of the output pixels back into its place in a full size
+    # image (such as Rover.vision_image), scaling it back up if downsampled
+    def expand(self, img, out):
+        r0, r1, c0, c1 = self.roi
+        if self.downsample > 1:
+            img = cv2.resize(img, (c1 - c0, r1 - r0), interpolation=cv2.INTER_NEAREST)
+        out[r0:r1, c0:c1] = img
+
+
+# Pixel classes produced by the terrain classifier
+OUT_OF_VIEW = 0
+NAVIGABLE = 1
+OBSTACLE = 2
+ROCK = 3
+
+# Colours used for each class in Rover.vision_image
+CLASS_COLORS = np.uint8([[0, 0, 0], [0, 0, 255], [255, 0, 0], [255, 255, 0]])
+
+# Define a class to label every pixel of the warped image in a single pass.
+# Each RGB value is looked up in a 256x256x256 table holding its class, so
+# navigable terrain, obstacles, rock samples and the out-of-view border are
+# all found at once.  The table is only rebuilt when the thresholds change.
+class TerrainClassifier():
+    def __init__(self, rgb_thresh=(160, 160, 160), rgb_thresh_rock=(100, 100, 50), border_color=(0, 255, 255)):
+        self.rgb_thresh = rgb_thresh
+        self.rgb_thresh_rock = rgb_thresh_rock
+        self.border_color = border_color
+        self.lut = None
+        self.lut_key = None
+        # Per-frame buffers, allocated on first use and then reused.  They are
+        # kept per thread so rovers sharing a classifier can run in parallel.
+        self.buffers = threading.local()
+
+    # Build the RGB -> class lookup table for the current thresholds
+    def build_lut(self):
+        levels = np.arange(256)
+        red = levels[:, None, None]
+        green = levels[None, :, None]
+        blue = levels[None, None, :]
+        lut = np.full((256, 256, 256), OBSTACLE, dtype=np.uint8)
+        # Same rules as color_thresh(), find_rocks() and border_thresh()
+        lut[(red > self.rgb_thresh[0]) & (green > self.rgb_thresh[1]) & (blue > self.rgb_thresh[2])] = NAVIGABLE
+        lut[(red > self.rgb_thresh_rock[0]) & (green > self.rgb_thresh_rock[1]) & (blue < self.rgb_thresh_rock[2])] = ROCK
+        lut[self.border_color[0], self.border_color[1], self.border_color[2]] = OUT_OF_VIEW
+        self.lut = lut.ravel()
+        self.lut_key = (tuple(self.rgb_thresh), tuple(self.rgb_thresh_rock), tuple(self.border_color))
+
+    # Return the lookup table, rebuilding it if the thresholds changed
+    def current_lut(self):
+        if self.lut_key != (tuple(self.rgb_thresh), tuple(self.rgb_thresh_rock), tuple(self.border_color)):
+            self.build_lut()
+        return self.lut
+
+    # Return a label image (one of the classes above for each pixel).  The
+    # returned array is an internal buffer which is overwritten on the next
+    # call from the same thread.
+    def classify(self, img, fov_mask=None):
+        lut = self.current_lut()
+        buffers = self.buffers
+        if getattr(buffers, 'index', None) is None or buffers.index.shape != img.shape[:2]:
+            buffers.index = np.zeros(img.shape[:2], dtype=np.uint32)
+            buffers.labels = np.zeros(img.shape[:2], dtype=np.uint8)
+        index = buffers.index
+        labels = buffers.labels
+        # Pack the three channels into a single 24-bit table index
+        np.copyto(index, img[:,:,0])
+        index <<= 8
+        index |= img[:,:,1]
+        index <<= 8
+        index |= img[:,:,2]
+        np.take(lut, index, out=labels)
+        # Anything outside the camera field of view is out of view (class 0)
+        if fov_mask is not None:
+            np.multiply(labels, fov_mask, out=labels)
+        return labels
+
+
+# Map update engines.  'scatter' projects every classified pixel with
+# pix_to_world() and writes it into the map by fancy indexing; 'raster' warps a
+# small rover-frame tile of class coverage into the map with one affine warp.
+MAP_ENGINES = ('scatter', 'raster')
+
+# Channels of the rover-frame tile used by the raster engine (navigable, obstacle, rock)
+TILE_CHANNELS = np.uint8([[0, 0, 0], [255, 0, 0], [0, 255, 0], [0, 0, 255]])
+# Minimum navigable coverage (out of 255) for a map cell to count as visited in the raster engine
+TILE_VISIT_COVERAGE = 128
+# Visit counts saturate here so the uint16 countermap never wraps around
+VISIT_LIMIT = 65535
+
+# Define a function to build the affine transform taking warped image pixels
+# (column, row) to continuous world map coordinates (x, y)
+def pixel_to_world_affine(camera, xpos, ypos, yaw, scale):
+    yaw_rad = yaw * np.pi / 180
+    rotation = np.array([[np.cos(yaw_rad), -np.sin(yaw_rad)],
+                         [np.sin(yaw_rad), np.cos(yaw_rad)]]) / scale
+    affine = np.zeros((2, 3))
+    affine[:, :2] = rotation.dot(camera.rover_affine[:, :2])
+    affine[:, 2] = rotation.dot(camera.rover_affine[:, 2]) + [xpos, ypos]
+    return affine
+
+# Define a function to find the bounding box (x0, y0, x1, y1) of the cells of
+# the world map under an image of img_shape, given the affine transform taking
+# image pixels to cell coordinates, clipped to the map
+def world_bounds(affine, img_shape, world_shape):
+    rows, cols = img_shape[0], img_shape[1]
+    corners = affine[:, :2].dot(np.float64([[-0.5, cols - 0.5, cols - 0.5, -0.5],
+                                            [-0.5, -0.5, rows - 0.5, rows - 0.5]]))
+    corners += affine[:, 2:]
+    x0 = max(int(np.floor(corners[0].min())), 0)
+    y0 = max(int(np.floor(corners[1].min())), 0)
+    x1 = min(int(np.ceil(corners[0].max())) + 1, world_shape[1])
+    y1 = min(int(np.ceil(corners[1].max())) + 1, world_shape[0])
+    return x0, y0, x1, y1
+
+# Define a function to composite the classified view into the occupancy grid
+# and countermap with a single affine warp (the 'raster' map engine)
+def raster_map_update(Rover, labels, affine, scale):
+    rows, cols = labels.shape
+    # Coverage of each class over blocks of scale x scale pixels (one map cell
+    # each), at least one block even if the view is smaller than a cell
+    tile = cv2.resize(np.take(TILE_CHANNELS, labels, axis=0), (max(cols // scale, 1), max(rows // scale, 1)),
+                      interpolation=cv2.INTER_AREA)
+    # Tile pixel (u, v) is centred on warped pixel (u*sx + (sx-1)/2, v*sy + (sy-1)/2)
+    step_x = cols / float(tile.shape[1])
+    step_y = rows / float(tile.shape[0])
+    tile_affine = np.zeros((2, 3))
+    tile_affine[:, 0] = affine[:, 0] * step_x
+    tile_affine[:, 1] = affine[:, 1] * step_y
+    tile_affine[:, 2] = affine[:, :2].dot([(step_x - 1)/2, (step_y - 1)/2]) + affine[:, 2]
+    # Map cell x covers world coordinates [x, x+1), so shift by half a cell
+    tile_affine[:, 2] -= 0.5
+    # Bounding box of the tile in the world map, clipped to the map
+    x0, y0, x1, y1 = world_bounds(tile_affine, tile.shape, Rover.occupancy.shape)
+    if x1 <= x0 or y1 <= y0:
+        return
+    tile_affine[:, 2] -= [x0, y0]
+    patch = cv2.warpAffine(tile, tile_affine, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR,
+                           borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+    # Turn coverage back into a number of observed pixels per cell
+    pixel_counts = patch * (step_x * step_y / 255.)
+    nav_counts = np.rint(pixel_counts[:,:,0])
+    obstacle_counts = np.rint(pixel_counts[:,:,1])
+    rock_counts = np.ceil(pixel_counts[:,:,2])
+    Rover.occupancy.add_patch(y0, x0, nav_counts, obstacle_counts, rock_counts)
+    visited = patch[:,:,0] >= TILE_VISIT_COVERAGE
+    if visited.any():
+        region = Rover.countermap.region(y0, y1, x0, x1)
+        region[visited & (region < VISIT_LIMIT)] += 1
+        Rover.countermap.put_region(y0, x0, region)
+
+# Define a function to sample a world grid back into the warped image frame,
+# returning the value of the map cell under each warped pixel
+def world_to_pixels(grid, affine, img_shape):
+    # Map cell x covers world coordinates [x, x+1), so shift by half a cell
+    lookup = affine.copy()
+    lookup[:, 2] -= 0.5
+    return cv2.warpAffine(grid, lookup, (img_shape[1], img_shape[0]),
+                          flags=cv2.INTER_NEAREST | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+# Same for a tiled world grid (see TiledArray): only the window of the grid
+# under the image is read
+def tiled_to_pixels(grid, affine, img_shape):
+    lookup = affine.copy()
+    lookup[:, 2] -= 0.5
+    x0, y0, x1, y1 = world_bounds(lookup, img_shape, grid.shape)
+    if x1 <= x0 or y1 <= y0:
+        return np.full(img_shape, grid.fill, dtype=grid.dtype)
+    window = affine.copy()
+    window[:, 2] -= [x0, y0]
+    return world_to_pixels(grid.region(y0, y1, x0, x1), window, img_shape)
+
+# Define a function to map rover-centric pixel coords to world map cells
+# (x, y) at scale pixels per cell.  Unlike pix_to_world() nothing is clipped,
+# the cells which fall off the map are left for the map to drop.
+def pix_to_cells(xpix, ypix, xpos, ypos, yaw, scale):
+    xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
+    xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+    return np.floor(xpix_tran).astype(np.int_), np.floor(ypix_tran).astype(np.int_)
+
+
 # Apply the above functions in succession and update the Rover state accordingly
 def perception_step(Rover):
     # Perform perception steps to update Rover()
     # TODO: 
     # NOTE: camera image is coming to you in Rover.img
-    # 1) Define source and destination points for perspective transform
-    dst_size = 5 
-    bottom_offset = 6
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    destination = np.float32([[Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - bottom_offset],
-                      [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - bottom_offset],
-                      [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset], 
-                      [Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset],
-                      ])
+    # 1) Source and destination points are fixed, they live in the precomputed camera model
+    camera = Rover.camera
     
     # 2) Apply perspective transform
-    warped = perspect_transform(Rover.img, source, destination)
+    warped = camera.warp(Rover.img)
     
-    # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    threshed_navigable = color_thresh(warped)
-    threshed_border = border_thresh(warped)
-    threshed_rocks = find_rocks(warped)
+    # 3) Classify every pixel as navigable terrain, obstacle, rock sample or out of view
+    labels = Rover.classifier.classify(warped, camera.fov_mask)
+    threshed_navigable = labels == NAVIGABLE
+    threshed_rocks = labels == ROCK
+    threshed_obstacle = labels == OBSTACLE
     
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
-    Rover.vision_image[:,:,0] = 255*(1-threshed_navigable)
-    Rover.vision_image[:,:,1] = 255*threshed_rocks
-    Rover.vision_image[:,:,2] = 255*threshed_navigable
-    Rover.vision_image[threshed_border,:] = 0
+    palette = CLASS_COLORS.astype(Rover.vision_image.dtype, copy=False)
+    if camera.full_frame:
+        np.take(palette, labels, axis=0, out=Rover.vision_image)
+    else:
+        camera.expand(np.take(palette, labels, axis=0), Rover.vision_image)
 
-    # 5) Convert map image pixel values to rover-centric coords
-    xpix_navigable, ypix_navigable = rover_coords(threshed_navigable)
+    # 5) Look up rover-centric coords (and polar coords) of the navigable pixels
+    xpix_navigable, ypix_navigable, dists, angles = camera.polar_coords(threshed_navigable)
     
     # 6) Convert rover-centric pixel values to world coordinates
     xpos = Rover.pos[0]
     ypos = Rover.pos[1]
     yaw = Rover.yaw
-    world_size = Rover.worldmap.shape[0]
+    # Rock samples are located in meters (10 pixels each), the maps have
+    # map_resolution cells per meter
     scale = 10
-    # Navigable terrain
-    xpix_navigable_world, ypix_navigable_world = pix_to_world(
-        xpix_navigable, ypix_navigable, xpos, ypos, yaw, world_size, scale) 
-    # Rock samples
+    resolution = Rover.map_resolution
+    xcell = xpos * resolution
+    ycell = ypos * resolution
+    cell_scale = float(scale) / resolution
+    # Only map while the rover is level and not picking up a sample
+    update_map = (Rover.roll < 0.3 or Rover.roll > 359.7) and (Rover.pitch < 0.3 or Rover.pitch > 359.7) and not Rover.picking_up
+    # Cells changed by this frame (if any) are tracked from here on
+    Rover.occupancy.clear_changes()
+    # Rock samples: one detection per blob of rock pixels, tracked from frame to frame
+    xblob_world = yblob_world = blob_areas = np.zeros(0)
     if threshed_rocks.any():
-        xpix_rock, ypix_rock = rover_coords(threshed_rocks)
-        xpix_rock_world, ypix_rock_world = pix_to_world(
-            xpix_rock, ypix_rock, xpos, ypos, yaw, world_size, scale)
-        # Calcualte the distances and angles of the rock
-        dists_rock, angles_rock = to_polar_coords(xpix_rock, ypix_rock)
-        Rover.rock_dists = dists_rock
-        Rover.rock_angles = angles_rock
-        
-    # Obstacles
-    threshed_obstacle = np.zeros_like(threshed_navigable)
-    threshed_obstacle[threshed_navigable==0] = 1
-    xpix_obstacle, ypix_obstacle = rover_coords(threshed_obstacle)
-    xpix_obstacle_world, ypix_obstacle_world = pix_to_world(
-        xpix_obstacle, ypix_obstacle, xpos, ypos, yaw, world_size, scale)
-    
-    # 7) Update Rover worldmap (to be displayed on right side of screen) and the countermap.
-    if (Rover.roll < 0.3 or Rover.roll > 359.7) and (Rover.pitch < 0.3 or Rover.pitch > 359.7) and not Rover.picking_up:
-        # Obstacles
-        Rover.worldmap[ypix_obstacle_world, xpix_obstacle_world, 0] = 255
+        xpix_rock, ypix_rock = camera.rover_coords(threshed_rocks)
+        xblob, yblob, blob_areas = rock_blobs(threshed_rocks, camera, Rover.toward_rock)
+        xblob_rot, yblob_rot = rotate_pix(xblob, yblob, yaw)
+        xblob_world, yblob_world = translate_pix(xblob_rot, yblob_rot, xpos, ypos, scale)
+        # Add the rock to the rock index (clusters of rock detections in world coords)
+        if update_map:
+            xpix_rot, ypix_rot = rotate_pix(xpix_rock, ypix_rock, yaw)
+            xrock_world, yrock_world = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+            Rover.rocks.add_detections(xrock_world, yrock_world, Rover.total_time)
+            Rover.samples_located = Rover.rocks.samples_located
+
+    if Rover.map_engine == 'raster':
+        # 7) Composite the classified view into the occupancy grid and countermap with one affine warp
+        affine = pixel_to_world_affine(camera, xcell, ycell, yaw, cell_scale)
+        if update_map:
+            raster_map_update(Rover, labels, affine, max(int(round(cell_scale / camera.downsample)), 1))
+        # Visit counts of the map cells under the navigable pixels
+        nav_counts = tiled_to_pixels(Rover.countermap, affine, labels.shape)[threshed_navigable]
+    else:
+        # Navigable terrain
+        xpix_navigable_world, ypix_navigable_world = pix_to_cells(
+            xpix_navigable, ypix_navigable, xcell, ycell, yaw, cell_scale)
         # Rock samples
         if threshed_rocks.any():
-            Rover.worldmap[ypix_rock_world, xpix_rock_world, 1] = 255
-        # Navigable terrain
-        Rover.worldmap[ypix_navigable_world, xpix_navigable_world, 2] = 255
-        Rover.worldmap[ypix_navigable_world, xpix_navigable_world, 0] = 0
-        # Countermap
-        Rover.countermap[ypix_navigable_world, xpix_navigable_world] += 1
-
-    # 8) Convert rover-centric pixel positions to polar coordinates
-    dists, angles = to_polar_coords(xpix_navigable, ypix_navigable)
-    # Update Rover pixel distances and angles
-    Rover.nav_weights = np.exp(-Rover.countermap[ypix_navigable_world, xpix_navigable_world]/100.)
+            xpix_rock_world, ypix_rock_world = pix_to_cells(
+                xpix_rock, ypix_rock, xcell, ycell, yaw, cell_scale)
+        # Obstacles
+        xpix_obstacle, ypix_obstacle = camera.rover_coords(threshed_obstacle)
+        xpix_obstacle_world, ypix_obstacle_world = pix_to_cells(
+            xpix_obstacle, ypix_obstacle, xcell, ycell, yaw, cell_scale)
+
+        # 7) Accumulate the observations into the occupancy grid and update the countermap.
+        if update_map:
+            nav_cells = Rover.occupancy.cells(xpix_navigable_world, ypix_navigable_world)
+            obstacle_cells = Rover.occupancy.cells(xpix_obstacle_world, ypix_obstacle_world)
+            rock_cells = None
+            if threshed_rocks.any():
+                rock_cells = Rover.occupancy.cells(xpix_rock_world, ypix_rock_world)
+            Rover.occupancy.add_pixels(nav_cells, obstacle_cells, rock_cells)
+            # Countermap (saturating), once for each cell seen navigable
+            if len(nav_cells) > 0:
+                first = nav_cells.min()
+                seen = np.flatnonzero(np.bincount(nav_cells - first)) + first
+                nav_counts = Rover.countermap.take_flat(seen)
+                Rover.countermap.put_flat(seen, np.minimum(nav_counts, VISIT_LIMIT - 1) + 1)
+        # Visit counts of the map cells under the navigable pixels
+        nav_counts = Rover.countermap[ypix_navigable_world, xpix_navigable_world]
+
+    # 8) Update Rover pixel distances and angles (polar coords came from the camera tables)
+    Rover.nav_weights = np.exp(-nav_counts/100.)
     Rover.nav_weights = Rover.nav_weights/Rover.nav_weights.sum()
     Rover.nav_dists = dists
     Rover.nav_angles = angles
-    # Update navigation weights for return
-    # Calculate the x and y distance from all the current navigable pixels to the starting position
-    dist_ys = np.abs(ypix_navigable_world-Rover.start_pos[1])
-    dist_xs = np.abs(xpix_navigable_world-Rover.start_pos[0])
-    dist_to_starts = np.sqrt(dist_ys**2+dist_xs**2)
-    Rover.return_weights = np.exp(-dist_to_starts/2.)
-    Rover.return_weights = Rover.return_weights/Rover.return_weights.sum()
+    # Range (pixels) and bearing (degrees) of the nearest tracked rock, which
+    # is held through frames where it drops out of view
+    Rover.rock_tracker.update(xblob_world, yblob_world, blob_areas)
+    Rover.rock_target = Rover.rock_tracker.nearest(xpos, ypos)
+    if Rover.rock_target is not None:
+        dx = Rover.rock_target.x - xpos
+        dy = Rover.rock_target.y - ypos
+        Rover.rock_dist = np.hypot(dx, dy) * scale
+        Rover.rock_angle = (np.arctan2(dy, dx) * 180/np.pi - yaw + 180) % 360 - 180
+    else:
+        Rover.rock_dist = None
+        Rover.rock_angle = None
+
+    # Keep the distance-to-start field current around the cells that changed this
+    # frame (none unless mapping), carrying on with the work left from earlier frames
+    if Rover.home.goal is None:
+        Rover.home.set_goal(Rover.start_pos[0] * resolution, Rover.start_pos[1] * resolution,
+                            Rover.occupancy.navigable())
+    else:
+        Rover.home.update(Rover.occupancy.changed, Rover.occupancy.logodds)
+
+    # Keep the frontier index current and, while exploring, favour the navigable
+    # pixels lying towards the best frontier cluster
+    if update_map:
+        Rover.frontiers.update(Rover.occupancy.changed, Rover.occupancy.logodds)
+    Rover.explore_heading = None
+    if Rover.samples_collected < 6:
+        heading = Rover.frontiers.target_heading(xcell, ycell)
+        if heading is not None:
+            Rover.explore_heading = (heading - yaw + 180) % 360 - 180
+            bias = np.exp(-((angles*180/np.pi - Rover.explore_heading)/TARGET_SPREAD)**2)
+            Rover.nav_weights = Rover.nav_weights*(TARGET_FLOOR + bias)
+            Rover.nav_weights = Rover.nav_weights/max(Rover.nav_weights.sum(), 1e-12)
+
+    # Update navigation weights for return (only needed once all the samples are collected)
+    if Rover.samples_collected == 6:
+        heading = Rover.home.descent_heading(xcell, ycell, 3 * resolution)
+        if heading is not None:
+            # Favour the navigable pixels lying in the downhill direction of the distance field
+            relative_heading = (heading - yaw + 180) % 360 - 180
+            Rover.return_weights = np.exp(-((angles*180/np.pi - relative_heading)/20.)**2)
+        else:
+            # Fall back on the straight-line distance from the navigable pixels to the starting position
+            xpix_rot, ypix_rot = rotate_pix(xpix_navigable, ypix_navigable, yaw)
+            xpix_world, ypix_world = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
+            dist_ys = np.abs(ypix_world-Rover.start_pos[1])
+            dist_xs = np.abs(xpix_world-Rover.start_pos[0])
+            dist_to_starts = np.sqrt(dist_ys**2+dist_xs**2)
+            Rover.return_weights = np.exp(-dist_to_starts/2.)
+        Rover.return_weights = Rover.return_weights/max(Rover.return_weights.sum(), 1e-12)
     
     return Rover
\ No newline at end of file
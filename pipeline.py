@@ -0,0 +1,136 @@
+import time
+import numpy as np
+import eventlet
+from eventlet import tpool
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, update_history, decode_image, create_output_images
+
+# How the telemetry handler runs the work of a frame:
+#   'serial'   -> everything on the eventlet hub, as the handler always did
+#   'offload'  -> decode and perception run on eventlet's native thread
+#                 pool, the hub keeps serving sockets meanwhile
+#   'pipeline' -> as 'offload', but the reply to frame N carries the commands
+#                 decided from frame N-1, so perception of frame N runs while
+#                 the simulator renders and sends frame N+1, whose decode
+#                 overlaps with it (one frame of control latency)
+EXECUTION_MODES = ('serial', 'offload', 'pipeline')
+
+# Reply to send when there is nothing to act on: (send pickup, commands, inset image 1, inset image 2)
+NULL_REPLY = (False, (0, 0, 0), '', '')
+
+# Define a class to run the frames of one rover in one of the execution modes.
+# step() takes a telemetry dict and returns the reply to send, as
+# (send pickup, (throttle, brake, steer), inset image 1, inset image 2).
+class FrameRunner():
+    def __init__(self, Rover, metrics, inset_encoder=None, recorder=None, mode='serial', checkpointer=None):
+        self.Rover = Rover
+        self.metrics = metrics
+        self.inset_encoder = inset_encoder
+        self.recorder = recorder
+        self.checkpointer = checkpointer
+        self.mode = mode
+        # Two decode buffers, so frame N+1 can be decoded while frame N is in use
+        self.buffers = [Rover.img_buffer, np.zeros_like(Rover.img_buffer)]
+        self.frame = 0
+        self.in_flight = None # Green thread waiting on perception of the previous frame
+        self.perceived = False # Whether the previous frame went through perception
+
+    def step(self, data):
+        if self.mode == 'pipeline':
+            return self.pipelined_step(data)
+        metrics = self.metrics
+        metrics.begin()
+        # Initialize / update Rover with current telemetry
+        if self.mode == 'offload':
+            img = tpool.execute(decode_image, data['image'], self.Rover.img_buffer)
+            Rover = update_rover(self.Rover, data, img=img)
+        else:
+            Rover = update_rover(self.Rover, data)
+        self.record(data)
+        metrics.lap()
+        if not np.isfinite(Rover.vel):
+            return NULL_REPLY
+        # Update the frame counters and the velocity history, then execute
+        # the perception and decision steps to update the Rover's state
+        if self.mode == 'offload':
+            tpool.execute(self.perceive)
+        else:
+            self.perceive()
+        metrics.lap(Rover)
+        decision_step(Rover)
+        metrics.lap()
+        reply = self.reply()
+        self.checkpoint()
+        metrics.lap()
+        metrics.end_frame(Rover)
+        return reply
+
+    def pipelined_step(self, data):
+        metrics = self.metrics
+        metrics.begin()
+        # Decode this frame while the previous one may still be in perception
+        slot = self.frame % 2
+        self.frame += 1
+        decode = eventlet.spawn(tpool.execute, decode_image, data['image'], self.buffers[slot])
+        self.buffers[slot] = decode.wait()
+        metrics.lap()
+        # Wait for perception of the previous frame: what is left of it is
+        # this frame's perception stage
+        if self.in_flight is not None:
+            self.in_flight.wait()
+            self.in_flight = None
+        # Reply with the decision taken from the previous frame
+        reply = NULL_REPLY
+        if self.perceived:
+            metrics.lap(self.Rover)
+            decision_step(self.Rover)
+            metrics.lap()
+            reply = self.reply()
+            self.checkpoint()
+            metrics.lap()
+            metrics.end_frame(self.Rover)
+        # Then start perception of this frame in the background
+        Rover = update_rover(self.Rover, data, img=self.buffers[slot])
+        self.record(data)
+        self.perceived = bool(np.isfinite(Rover.vel))
+        if self.perceived:
+            self.in_flight = eventlet.spawn(tpool.execute, self.perceive)
+        return reply
+
+    def perceive(self):
+        update_history(self.Rover)
+        perception_step(self.Rover)
+
+    # Queue the raw telemetry and decoded frame for the recorder (written in the background)
+    def record(self, data):
+        if self.recorder is not None:
+            self.recorder.append(data, self.Rover.img, time.time())
+
+    # Hand the map to the checkpointer (a copy of the changed tiles, now and then)
+    def checkpoint(self):
+        if self.checkpointer is not None:
+            self.checkpointer.snapshot(self.Rover)
+
+    # Build the reply from the current Rover state
+    def reply(self):
+        Rover = self.Rover
+        # Create output images to send to server
+        # (in the background by default, sending the latest finished pair)
+        if self.inset_encoder is not None:
+            image1, image2 = self.inset_encoder.submit(Rover)
+        else:
+            image1, image2 = create_output_images(Rover)
+        # If in a state where want to pickup a rock send pickup command
+        if Rover.send_pickup and not Rover.picking_up:
+            # Reset Rover flags
+            Rover.send_pickup = False
+            return True, None, image1, image2
+        return False, (Rover.throttle, Rover.brake, Rover.steer), image1, image2
+
+    # Wait for the frame still in flight (pipeline mode)
+    def close(self):
+        if self.in_flight is not None:
+            self.in_flight.wait()
+            self.in_flight = None
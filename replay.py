@@ -0,0 +1,81 @@
+# Replay a recorded run (see telemetry_log.py) through the full control loop
+# without the simulator:
+#   update_rover -> perception_step -> decision_step -> create_output_images
+# Example: $ python replay.py recorded_run_folder --stats replay_stats.csv
+import argparse
+import csv
+import time
+import numpy as np
+
+from perception import perception_step, MAP_ENGINES, CameraModel
+from decision import decision_step
+from rover_state import RoverState, load_ground_truth
+from supporting_functions import update_rover, update_history, create_output_images
+from telemetry_log import TelemetryReader
+
+# Per-frame statistics written by the replay
+STATS_FIELDS = ['frame', 'seconds', 'mode', 'vel', 'perc_mapped', 'fidelity',
+                'samples_located', 'samples_collected', 'navigable_cells', 'obstacle_cells']
+
+# Define a function to feed every frame of a recording through the control loop
+# as fast as possible.  Returns the final Rover and the list of per-frame stats.
+def replay_run(Rover, reader, limit=None):
+    stats = []
+    start = time.time()
+    for frame_idx, (data, frame) in enumerate(reader):
+        if limit is not None and frame_idx >= limit:
+            break
+        Rover = update_rover(Rover, data, np.ascontiguousarray(frame))
+        if not np.isfinite(Rover.vel):
+            continue
+        Rover = update_history(Rover)
+        Rover = perception_step(Rover)
+        Rover = decision_step(Rover)
+        create_output_images(Rover)
+        # Pickups are not simulated, just clear the request as telemetry() would
+        Rover.send_pickup = False
+        navigable_cells, obstacle_cells = Rover.occupancy.cell_counts()
+        stats.append({'frame': frame_idx, 'seconds': time.time() - start, 'mode': Rover.mode,
+                      'vel': Rover.vel, 'perc_mapped': Rover.perc_mapped, 'fidelity': Rover.fidelity,
+                      'samples_located': Rover.samples_located,
+                      'samples_collected': Rover.samples_collected,
+                      'navigable_cells': navigable_cells, 'obstacle_cells': obstacle_cells})
+    return Rover, stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded run without the simulator')
+    parser.add_argument('run_folder', type=str, help='Folder written by drive_rover.py --record.')
+    parser.add_argument('--ground_truth', type=str, default='../calibration_images/map_bw.png',
+                        help='Ground truth map used for the fidelity statistics.')
+    parser.add_argument('--map_engine', type=str, choices=MAP_ENGINES, default='scatter',
+                        help='How classified pixels are written into the worldmap.')
+    parser.add_argument('--map_resolution', type=int, default=1, help='World map cells per meter.')
+    parser.add_argument('--roi', action='store_true', help='Warp and classify only the field of view (see CameraModel).')
+    parser.add_argument('--downsample', type=int, default=1, help='Warp and classify only every N-th row and column.')
+    parser.add_argument('--max_range', type=float, default=None, help='Drop pixels further than this from the rover.')
+    parser.add_argument('--seed', type=int, default=None, help='Seed the random choices of the decision step.')
+    parser.add_argument('--limit', type=int, default=None, help='Only replay the first N frames.')
+    parser.add_argument('--stats', type=str, default='', help='Optional CSV file for the per-frame statistics.')
+    args = parser.parse_args()
+
+    camera = CameraModel(roi=args.roi, downsample=args.downsample, max_range=args.max_range)
+    Rover = RoverState(load_ground_truth(args.ground_truth), camera, map_resolution=args.map_resolution, seed=args.seed)
+    Rover.map_engine = args.map_engine
+    reader = TelemetryReader(args.run_folder)
+
+    start = time.time()
+    Rover, stats = replay_run(Rover, reader, args.limit)
+    elapsed = time.time() - start
+
+    if args.stats != '':
+        with open(args.stats, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=STATS_FIELDS)
+            writer.writeheader()
+            writer.writerows(stats)
+
+    frames = len(stats)
+    print('Replayed {} frames in {:.2f} s ({:.1f} frames/sec)'.format(
+        frames, elapsed, frames / elapsed if elapsed > 0 else 0))
+    if frames > 0:
+        print('Mapped: {}%  Fidelity: {}%  Rocks located: {}  Collected: {}'.format(
+            Rover.perc_mapped, Rover.fidelity, Rover.samples_located, Rover.samples_collected))
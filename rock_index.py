@@ -0,0 +1,110 @@
+import numpy as np
+
+# Rock pixels within this distance (meters) of a cluster centroid join that cluster
+ROCK_CLUSTER_RADIUS = 3
+# A cluster within this distance (meters) of a known sample position locates that sample
+SAMPLE_MATCH_RADIUS = 3
+
+# Define a class to hold one detected rock: a cluster of rock observations in the world map
+class RockCluster():
+    def __init__(self, x, y, count, last_seen):
+        self.x = x # Centroid x (world meters)
+        self.y = y # Centroid y (world meters)
+        self.count = count # Number of rock pixels observed in the cluster
+        self.last_seen = last_seen # Time the cluster was last observed
+
+# Define a class to keep the detected rocks in a small spatial index.  Rocks
+# are hashed into buckets of ROCK_CLUSTER_RADIUS meters so that adding an
+# observation only looks at a handful of buckets, however many rock pixels
+# have been mapped so far.  Which known samples have been located is kept
+# up to date as clusters change, so querying it is constant time.
+class RockIndex():
+    def __init__(self, radius=ROCK_CLUSTER_RADIUS):
+        self.radius = radius
+        self.clusters = []
+        self.buckets = {} # (bucket x, bucket y) -> list of cluster ids
+        self.samples_pos = None # Known sample positions (xs, ys), see set_samples()
+        self.sample_found = np.zeros(0, dtype=bool) # Whether each known sample has been located
+        self.samples_located = 0
+
+    # Set the known sample positions used to confirm detections
+    def set_samples(self, samples_pos):
+        self.samples_pos = (np.asarray(samples_pos[0]), np.asarray(samples_pos[1]))
+        self.sample_found = np.zeros(len(self.samples_pos[0]), dtype=bool)
+        for cluster in self.clusters:
+            self.match_samples(cluster)
+
+    # Add a whole cluster (as when restoring a checkpoint)
+    def add_cluster(self, x, y, count, last_seen):
+        cluster = RockCluster(x, y, count, last_seen)
+        self.clusters.append(cluster)
+        self.buckets.setdefault(self.bucket(x, y), []).append(len(self.clusters) - 1)
+        self.match_samples(cluster)
+
+    def bucket(self, x, y):
+        return (int(x // self.radius), int(y // self.radius))
+
+    # Return (cluster id, distance) of the cluster nearest to (x, y) within max_dist, or (None, None)
+    def nearest_within(self, x, y, max_dist):
+        reach = int(np.ceil(max_dist / float(self.radius)))
+        bx, by = self.bucket(x, y)
+        best_id, best_dist = None, None
+        for gx in range(bx - reach, bx + reach + 1):
+            for gy in range(by - reach, by + reach + 1):
+                for cluster_id in self.buckets.get((gx, gy), ()):
+                    cluster = self.clusters[cluster_id]
+                    dist = np.hypot(cluster.x - x, cluster.y - y)
+                    if dist <= max_dist and (best_dist is None or dist < best_dist):
+                        best_id, best_dist = cluster_id, dist
+        return best_id, best_dist
+
+    # Return the known rock (RockCluster) nearest to world position (x, y)
+    # (meters), or None if no rock has been seen.  There are only ever a
+    # handful of clusters, so scan them all.
+    def nearest(self, x, y):
+        best, best_dist = None, None
+        for cluster in self.clusters:
+            dist = np.hypot(cluster.x - x, cluster.y - y)
+            if best_dist is None or dist < best_dist:
+                best, best_dist = cluster, dist
+        return best
+
+    # Mark the known samples lying close to a cluster as located
+    def match_samples(self, cluster):
+        if self.samples_pos is None:
+            return
+        dists = np.hypot(self.samples_pos[0] - cluster.x, self.samples_pos[1] - cluster.y)
+        self.sample_found |= dists < SAMPLE_MATCH_RADIUS
+        self.samples_located = int(self.sample_found.sum())
+
+    # Add one frame of rock pixels given their world coordinates (meters)
+    def add_detections(self, xs, ys, timestamp):
+        # Only rocks inside the positive quadrant of the map can be indexed
+        inside = (xs >= 0) & (ys >= 0)
+        xs = xs[inside]
+        ys = ys[inside]
+        if len(xs) == 0:
+            return
+        # Reduce the pixels to occupied 1 m squares first, a rock covers only a few
+        cells, counts = np.unique(np.int_(ys) * 100000 + np.int_(xs), return_counts=True)
+        for cell, count in zip(cells, counts):
+            x = cell % 100000 + 0.5
+            y = cell // 100000 + 0.5
+            cluster_id, dist = self.nearest_within(x, y, self.radius)
+            if cluster_id is None:
+                cluster = RockCluster(x, y, int(count), timestamp)
+                self.clusters.append(cluster)
+                self.buckets.setdefault(self.bucket(x, y), []).append(len(self.clusters) - 1)
+            else:
+                cluster = self.clusters[cluster_id]
+                old_bucket = self.bucket(cluster.x, cluster.y)
+                total = cluster.count + count
+                cluster.x = (cluster.x * cluster.count + x * count) / total
+                cluster.y = (cluster.y * cluster.count + y * count) / total
+                cluster.count = int(total)
+                cluster.last_seen = timestamp
+                new_bucket = self.bucket(cluster.x, cluster.y)
+                if new_bucket != old_bucket:
+                    self.buckets[old_bucket].remove(cluster_id)
+                    self.buckets.setdefault(new_bucket, []).append(cluster_id)
+            self.match_samples(cluster)
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+# Detections closer than this (meters) to a tracked rock are that rock
+ROCK_GATE = 2.
+# Weight of a new detection in the smoothed position of a tracked rock
+ROCK_GAIN = 0.5
+# Frames a tracked rock may go unseen before it is dropped
+ROCK_MAX_MISSES = 5
+
+# Define a function to find the blobs of a binary rock mask of the camera
+# output pixels (see CameraModel).  Returns the rover-centric coords of the
+# blob centroids (pixels) and their areas (full resolution pixels), keeping
+# the blobs of at least min_area pixels.
+def rock_blobs(mask, camera, min_area=1):
+    count, labels, stats, centroids = cv2.connectedComponentsWithStats(mask.view(np.uint8), connectivity=8)
+    # Component 0 is the background
+    areas = stats[1:, cv2.CC_STAT_AREA] * camera.pixel_area
+    keep = areas >= min_area
+    cols = centroids[1:, 0][keep]
+    rows = centroids[1:, 1][keep]
+    affine = camera.rover_affine
+    x = affine[0, 0]*cols + affine[0, 1]*rows + affine[0, 2]
+    y = affine[1, 0]*cols + affine[1, 1]*rows + affine[1, 2]
+    return x, y, areas[keep]
+
+# Define a class to hold one tracked rock
+class RockTrack():
+    __slots__ = ('x', 'y', 'area', 'hits', 'misses')
+
+    def __init__(self, x, y, area):
+        self.x = x # Smoothed world position (meters)
+        self.y = y
+        self.area = area # Area of the last detection (pixels)
+        self.hits = 1 # Frames it was detected in
+        self.misses = 0 # Frames since it was last detected
+
+# Define a class to track the rocks in view from frame to frame.  Each
+# frame's blobs are matched to the nearest track in world coordinates, whose
+# position is smoothed; unmatched blobs start new tracks and tracks unseen
+# for more than ROCK_MAX_MISSES frames are dropped.  Tracks living in world
+# coordinates stay put while the rover turns or loses sight of the rock for
+# a frame or two, so the decision step gets a steady target.
+class RockTracker():
+    def __init__(self, gate=ROCK_GATE, gain=ROCK_GAIN, max_misses=ROCK_MAX_MISSES):
+        self.gate = gate
+        self.gain = gain
+        self.max_misses = max_misses
+        self.tracks = []
+        self.pixels = 0 # Rock pixels detected in the last frame
+
+    # Update the tracks with one frame of detections (world x, y and area arrays)
+    def update(self, xs, ys, areas):
+        self.pixels = int(np.sum(areas))
+        for track in self.tracks:
+            track.misses += 1
+        # Biggest blobs first, they are the most reliable
+        for idx in np.argsort(areas)[::-1]:
+            x, y, area = xs[idx], ys[idx], areas[idx]
+            best, best_dist = None, self.gate
+            for track in self.tracks:
+                dist = np.hypot(track.x - x, track.y - y)
+                if track.misses > 0 and dist <= best_dist:
+                    best, best_dist = track, dist
+            if best is None:
+                self.tracks.append(RockTrack(x, y, area))
+            else:
+                best.x += self.gain * (x - best.x)
+                best.y += self.gain * (y - best.y)
+                best.area = area
+                best.hits += 1
+                best.misses = 0
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+    # Return the tracked rock nearest to world position (x, y), or None
+    def nearest(self, x, y):
+        best, best_dist = None, None
+        for track in self.tracks:
+            dist = np.hypot(track.x - x, track.y - y)
+            if best_dist is None or dist < best_dist:
+                best, best_dist = track, dist
+        return best
+
+    # Stop tracking a rock (once it has been picked up)
+    def drop(self, track):
+        if track in self.tracks:
+            self.tracks.remove(track)
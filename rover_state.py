@@ -0,0 +1,185 @@
+import numpy as np
+import matplotlib.image as mpimg
+
+from perception import CameraModel, TerrainClassifier
+from occupancy import OccupancyGrid
+from rock_index import RockIndex
+from rock_tracker import RockTracker
+from distance_field import DistanceField
+from exploration import FrontierIndex, FRONTIER_BLOCK
+from tiled_map import TiledArray, TILE_METERS
+
+# Side of the simulator world (meters, x and y run from 0 to WORLD_SIZE)
+WORLD_SIZE = 200
+# Mission parameters a run can be configured with (see RoverState.configure())
+MISSION_PARAMS = ('throttle_set', 'brake_set', 'toward_rock', 'stop_dist_rock', 'stop_forward', 'go_forward', 'max_vel')
+
+# Define a function to read in the ground truth map and create a 3-channel green
+# version for overplotting
+def load_ground_truth(path='../calibration_images/map_bw.png'):
+    # NOTE: images are read in by default with the origin (0, 0) in the upper left
+    # and y-axis increasing downward.
+    ground_truth = mpimg.imread(path)
+    # This next line creates arrays of zeros in the red and blue channels
+    # and puts the map into the green channel.  This is why the underlying 
+    # map output looks green in the display image
+    return np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.uint8)
+
+# Define a class to keep the last n velocities in a ring buffer together with
+# the running sum of their magnitudes, so the mean is O(1) per frame.  The sum
+# is recomputed exactly every time the ring wraps to stop rounding drift.
+class VelocityHistory():
+    __slots__ = ('values', 'index', 'total')
+
+    def __init__(self, n=160, fill=3.):
+        self.values = np.full(n, np.abs(fill), dtype=np.float32)
+        self.index = 0
+        self.total = float(self.values.sum())
+
+    def push(self, vel):
+        vel = abs(float(vel))
+        self.total += vel - float(self.values[self.index])
+        self.values[self.index] = vel
+        self.index += 1
+        if self.index == len(self.values):
+            self.index = 0
+            self.total = float(self.values.sum())
+
+    # Mean magnitude of the velocities in the history
+    def mean(self):
+        return self.total / len(self.values)
+
+# Define RoverState() class to retain rover state parameters.
+# The attributes are fixed by __slots__ (no per-instance __dict__) and the
+# arrays use the smallest dtype that holds their values.  Approximate memory
+# held per rover with the default 160x320 camera and 200x200 map (one cell
+# per meter; at --map_resolution N the per 20x20 m figures and the ground
+# truth mask grow N^2 times, e.g. 16 times at N = 4):
+#   img_buffer, vision_image (uint8)          150 KB each
+#   worldmap (uint8 RGB), ground_truth (uint8) 117 KB each
+#   countermap (uint16 tiles)                 0.8 KB per 20x20 m explored
+#   occupancy (int16 log-odds and rock count
+#              tiles)                         1.6 KB per 20x20 m explored
+#              ground truth mask               39 KB
+#   camera tables and warp maps                1.1 MB
+#   classifier lookup table (256^3 uint8)       16 MB
+#   home distance field (float32 tiles)       1.6 KB per 20x20 m explored
+#   frontier index (bool tiles)               0.8 KB per 20x20 m explored
+#                  block counts and sums        8 KB
+#   vel_history (float32 ring)                 0.6 KB
+# (vision_image and countermap used to be float64: 1.2 MB and 312 KB, the
+# home distance field and frontier index dense: 352 KB and 87 KB, 5.7 MB
+# at N = 4)
+class RoverState():
+    __slots__ = ('start_time', 'total_time', 'start_pos', 'img', 'img_buffer', 'pos', 'yaw', 'pitch',
+                 'roll', 'vel', 'vel_history', 'steer', 'throttle', 'brake', 'nav_angles', 'nav_weights',
+                 'return_weights', 'nav_dists', 'rock_tracker', 'rock_target', 'rock_dist', 'rock_angle',
+                 'ground_truth', 'mode', 'throttle_set', 'brake_set', 'toward_rock', 'stop_dist_rock', 'stop_forward', 'go_forward',
+                 'max_vel', 'vision_image', 'camera', 'classifier', 'map_resolution', 'occupancy', 'worldmap', 'countermap',
+                 'map_engine', 'samples_pos', 'samples_to_find', 'rocks', 'home', 'frontiers',
+                 'explore_heading', 'samples_located', 'perc_mapped', 'fidelity', 'inset_every',
+                 'inset_interval', 'inset_counter', 'inset_time', 'inset_images', 'samples_collected',
+                 'near_sample', 'picking_up', 'send_pickup', 'frame_counter2', 'frame_counter3', 'sign_steer', 'rng')
+
+    def __init__(self, ground_truth=None, camera=None, classifier=None, map_resolution=1, seed=None):
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.start_pos = None # To record the start posistion of navigation
+        self.img = None # Current camera image
+        self.img_buffer = np.zeros((160, 320, 3), dtype=np.uint8) # Reused buffer the camera image is decoded into
+        self.pos = None # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.pitch = None # Current pitch angle
+        self.roll = None # Current roll angle
+        self.vel = None # Current velocity
+        self.vel_history = VelocityHistory(160, 3.) # Last 160 velocities, used to check whether the rover is stuck or not.
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav_angles = None # Angles of navigable terrain pixels
+        self.nav_weights = None # Weights when calculating the averaged navigation angle
+        self.return_weights = None # Weights when calculating the averaged navigation angle for the returning of the Rover
+        self.nav_dists = None # Distances of navigable terrain pixels
+        self.rock_tracker = RockTracker() # Rocks in view, tracked from frame to frame
+        self.rock_target = None # Nearest tracked rock (None if none)
+        self.rock_dist = None # and its distance (rover-centric pixels)
+        self.rock_angle = None # and its bearing (degrees)
+        # Ground truth worldmap (see load_ground_truth())
+        self.ground_truth = None if ground_truth is None else np.asarray(ground_truth).astype(np.uint8)
+        self.mode = 'forward' # Current mode (can be forward, stop or sample)
+        self.throttle_set = 0.4 # Throttle setting when accelerating
+        self.brake_set = 15 # Brake setting when braking
+        # The stop_forward and go_forward fields below represent total count
+        # of navigable terrain pixels.  This is a very crude form of knowing
+        # when you can keep going and when you should stop.  Feel free to
+        # get creative in adding new fields or modifying these!
+        self.toward_rock = 1 # Smallest rock blob (pixels) to move toward
+        self.stop_dist_rock = 50 # Distance threshold to stop before a rock sample
+        self.stop_forward = 300 # Threshold to initiate stopping
+        self.go_forward = 1000 # Threshold to go forward again
+        self.max_vel = 3 # Maximum velocity (meters/second)
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8)
+        # Fixed camera geometry (perspective matrix, warp tables and field-of-view mask)
+        # and lookup-table classifier for navigable terrain, obstacles and rock samples.
+        # Rovers driven by one process can share them (pass them in).
+        self.camera = camera if camera is not None else CameraModel(self.vision_image.shape)
+        self.classifier = classifier if classifier is not None else TerrainClassifier()
+        # The pixel-count thresholds above are in full resolution pixels, a
+        # downsampling camera sees fewer (bigger) ones
+        self.stop_forward = self.stop_forward / self.camera.pixel_area
+        self.go_forward = self.go_forward / self.camera.pixel_area
+        # Map cells per meter.  The maps below cover the world at this
+        # resolution, the inset worldmap stays at one pixel per meter.
+        self.map_resolution = map_resolution
+        map_shape = (WORLD_SIZE * map_resolution, WORLD_SIZE * map_resolution)
+        tile = TILE_METERS * map_resolution
+        # Occupancy grid
+        # Log-odds evidence of navigable terrain and obstacles plus rock
+        # sample observations, accumulated every frame
+        self.occupancy = OccupancyGrid(map_shape, tile)
+        if ground_truth is not None:
+            truth = ground_truth[:,:,1] > 0
+            self.occupancy.set_ground_truth(truth.repeat(map_resolution, 0).repeat(map_resolution, 1))
+        # Worldmap
+        # Display image rendered from the occupancy grid (only the tiles which changed are re-rendered)
+        self.worldmap = np.zeros((WORLD_SIZE, WORLD_SIZE, 3), dtype=np.uint8)
+        # Keep records of how many times each position has been mapped.
+        # (saturates at 65535, see VISIT_LIMIT in perception.py)
+        self.countermap = TiledArray(map_shape, tile, np.uint16, fill=1)
+        # How classified pixels are written into the worldmap ('scatter' or 'raster')
+        self.map_engine = 'scatter'
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.rocks = RockIndex() # Spatial index of the rocks detected so far
+        self.home = DistanceField(map_shape, tile) # Grid distance to the start position over known navigable cells
+        self.frontiers = FrontierIndex(map_shape, FRONTIER_BLOCK * map_resolution, tile) # Known navigable cells bordering unexplored terrain
+        self.explore_heading = None # Heading (degrees, rover frame) towards the best frontier, None if none is left
+        self.samples_located = 0 # To store number of samples located on map
+        self.perc_mapped = 0 # Percentage of the ground truth map found so far
+        self.fidelity = 0 # Percentage of mapped navigable terrain matching the ground truth
+        self.inset_every = 1 # Re-render the inset images at most every N frames
+        self.inset_interval = 0 # and at most every T milliseconds
+        self.inset_counter = 0 # Frames since the inset images were last rendered
+        self.inset_time = 0 # Time the inset images were last rendered
+        self.inset_images = None # Last pair of encoded inset images
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        self.frame_counter2 = 0 # Count the number of frames
+        self.frame_counter3 = 0 # Count the number of frames
+        self.sign_steer = 0 # Left or Right for the 15-turn.
+        self.rng = np.random.RandomState(seed) # Random choices of the decision step (seed it for repeatable runs)
+
+    # Set mission parameters (names in MISSION_PARAMS).  The pixel-count
+    # thresholds are given in full resolution pixels, like the defaults.
+    def configure(self, params):
+        for name, value in params.items():
+            if name not in MISSION_PARAMS:
+                raise ValueError('Unknown mission parameter {}'.format(name))
+            if name in ('stop_forward', 'go_forward'):
+                value = value / self.camera.pixel_area
+            setattr(self, name, value)
@@ -3,17 +3,44 @@ import cv2
 from PIL import Image
 from io import BytesIO, StringIO
 import base64
+import copy
 import time
 
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
-      if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
-      else: 
-            float_value = np.float(string_to_convert)
-      return float_value
+      try:
+            return float(string_to_convert)
+      except ValueError:
+            return float(string_to_convert.replace(',','.'))
 
-def update_rover(Rover, data):
+# Telemetry fields holding a single number and the Rover attribute each one updates
+FLOAT_FIELDS = (('speed', 'vel'), # The current speed of the rover in m/s
+                ('yaw', 'yaw'), # The current yaw angle of the rover
+                ('pitch', 'pitch'), # The current pitch angle of the rover
+                ('roll', 'roll'), # The current roll angle of the rover
+                ('throttle', 'throttle'), # The current throttle setting
+                ('steering_angle', 'steer')) # The current steering angle
+INT_FIELDS = (('near_sample', 'near_sample'), # Near sample flag
+              ('picking_up', 'picking_up')) # Picking up flag
+
+# Define a function to decode the base64 JPEG camera image straight into a
+# reusable RGB buffer (a new buffer is only allocated if the size changes)
+def decode_image(img_string, buffer=None):
+      jpeg = np.frombuffer(base64.b64decode(img_string), dtype=np.uint8)
+      bgr = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+      if buffer is None or buffer.shape != bgr.shape:
+            buffer = np.empty(bgr.shape, dtype=np.uint8)
+      cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=buffer)
+      return buffer
+
+# Define a function to JPEG/base64-encode an RGB frame like the simulator does
+def encode_frame(frame):
+      ok, buff = cv2.imencode('.jpg', cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+      return base64.b64encode(buff.tobytes()).decode('utf-8')
+
+# (img can be passed in directly, e.g. when replaying a recording, in which case
+# the telemetry image string is not decoded.)
+def update_rover(Rover, data, img=None):
       # Initialize start time and sample positions
       if Rover.start_time == None:
             Rover.start_time = time.time()
@@ -21,126 +48,162 @@ def update_rover(Rover, data):
             samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
             samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.rocks.set_samples(Rover.samples_pos)
+            Rover.samples_to_find = int(data["sample_count"])
       # Or just update elapsed time
       else:
             tot_time = time.time() - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
+      # The current position of the rover
+      Rover.pos = [convert_to_float(pos) for pos in data["position"].split(';')]
       # Initialize the starting position of the rover
       if Rover.start_pos == None:
-            Rover.start_pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-            
-      # Print out the fields in the telemetry data dictionary
-      print(data.keys())
-      # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
-      # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
-      # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
-      # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
-      # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
-      # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
-      # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
-      # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
-      # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+            Rover.start_pos = list(Rover.pos)
+
+      # Parse the scalar fields in one pass
+      for key, attr in FLOAT_FIELDS:
+            setattr(Rover, attr, convert_to_float(data[key]))
+      for key, attr in INT_FIELDS:
+            setattr(Rover, attr, int(data[key]))
       # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
+      Rover.samples_collected = Rover.samples_to_find - int(data["sample_count"])
 
-      print('speed =',Rover.vel, 'start position =', Rover.start_pos, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
       # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      if img is not None:
+            Rover.img = img
+      else:
+            Rover.img_buffer = decode_image(data["image"], Rover.img_buffer)
+            Rover.img = Rover.img_buffer
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      # Return updated Rover
+      return Rover
 
-# Define a function to create display output given worldmap results
-def create_output_images(Rover):
-
-      # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
-      else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
+# Define a function to update the frame counters and the velocity history
+# once per valid telemetry frame, before the perception and decision steps
+def update_history(Rover):
+      # Update frame counter 3
+      if Rover.frame_counter3 >= 3000:
+            Rover.frame_counter3 = 0
       else:
-            obstacle = Rover.worldmap[:,:,0]
-
-      likely_nav = navigable >= obstacle
-      obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
-      plotmap[:, :, 0] = obstacle
-      plotmap[:, :, 2] = navigable
-      plotmap = plotmap.clip(0, 255)
-      # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
-            rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-      # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
+            Rover.frame_counter3 += 1
+      
+      # Get the sign of steering
+      if Rover.frame_counter3 == 2900:
+            Rover.sign_steer = np.sign(Rover.rng.random_sample() - 0.5)
+      
+      # Update frame counter 2
+      if Rover.frame_counter2 >= 159:
+            Rover.frame_counter2 = 0
+      else:
+            Rover.frame_counter2 += 1
+      
+      # Update velocity history
+      if Rover.mode == 'stop' or Rover.mode == 'sample':
+            Rover.vel_history.push(Rover.max_vel)
+      else:
+            Rover.vel_history.push(Rover.vel)
+      return Rover
+
+# Define a function to update the map statistics.  The occupancy grid keeps its
+# navigable cell counts up to date from the cells changed each frame, so this
+# does not scan the map.
+def update_map_statistics(Rover):
+      occupancy = Rover.occupancy
+      # Total number of cells in the navigable terrain map
+      tot_nav_pix = float(occupancy.nav_count)
+      # How many of those correspond to ground truth cells
+      good_nav_pix = float(occupancy.good_nav_count)
+      # Total number of ground truth navigable cells
+      tot_map_pix = float(occupancy.truth_count)
       # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
+      if tot_map_pix > 0:
+            Rover.perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
+      else:
+            Rover.perc_mapped = 0
       # Calculate the number of good map pixel detections divided by total pixels 
       # found to be navigable terrain
       if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
+            Rover.fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
       else:
-            fidelity = 0
+            Rover.fidelity = 0
+      return Rover
+
+# Define a function to decide whether the inset images are due to be re-rendered:
+# at most every Rover.inset_every frames and every Rover.inset_interval milliseconds
+def inset_due(Rover):
+      Rover.inset_counter += 1
+      if Rover.inset_images is None:
+            return True
+      if Rover.inset_counter < Rover.inset_every:
+            return False
+      if (time.time() - Rover.inset_time)*1000 < Rover.inset_interval:
+            return False
+      return True
+
+# Define a function to create display output given worldmap results
+def create_output_images(Rover):
+
+      # Statistics are cheap to keep current every frame
+      update_map_statistics(Rover)
+      # The display only needs refreshing now and then, reuse the last insets otherwise
+      if not inset_due(Rover):
+            return Rover.inset_images
+      Rover.inset_counter = 0
+      Rover.inset_time = time.time()
+      update_worldmap(Rover)
+      Rover.inset_images = render_output_images(Rover)
+      return Rover.inset_images
+
+# Define a function to bring Rover.worldmap up to date by re-rendering only
+# the map tiles which changed since it was last rendered
+def update_worldmap(Rover):
+      Rover.occupancy.render(Rover.worldmap, Rover.occupancy.take_dirty())
+      return Rover
+
+# Define a function to take a copy of everything render_output_images() reads,
+# so the insets can be rendered elsewhere while the Rover keeps changing.
+# The changed map tiles are rendered here, the copy only needs the worldmap.
+def snapshot_output_state(Rover):
+      update_worldmap(Rover)
+      snapshot = copy.copy(Rover)
+      snapshot.rocks = copy.copy(Rover.rocks)
+      snapshot.rocks.sample_found = Rover.rocks.sample_found.copy()
+      snapshot.vision_image = Rover.vision_image.copy()
+      snapshot.worldmap = Rover.worldmap.copy()
+      snapshot.pos = list(Rover.pos)
+      return snapshot
+
+# Define a function to render and encode the map and vision inset images
+def render_output_images(Rover):
+
+      # The occupancy grid rendered for plotting (obstacles red, rocks green,
+      # navigable terrain blue, see update_worldmap())
+      plotmap = Rover.worldmap
+      # Overlay obstacle and navigable terrain map with ground truth map
+      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0, dtype=cv2.CV_8U)
+
+      # Plot the known sample positions which the rock index has confirmed
+      # (a rock detected within 3 meters of the known position)
+      rock_size = 2
+      for idx in np.flatnonzero(Rover.rocks.sample_found):
+            test_rock_x = Rover.samples_pos[0][idx]
+            test_rock_y = Rover.samples_pos[1][idx]
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
       # Flip the map for plotting so that the y-axis points upward in the display
-      map_add = np.flipud(map_add).astype(np.float32)
+      map_add = np.ascontiguousarray(np.flipud(map_add))
       # Add some text about map and rock sample detection results
       cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      cv2.putText(map_add,"Mapped: "+str(perc_mapped)+'%', (0, 25), 
+      cv2.putText(map_add,"Mapped: "+str(Rover.perc_mapped)+'%', (0, 25), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      cv2.putText(map_add,"Fidelity: "+str(fidelity)+'%', (0, 40), 
+      cv2.putText(map_add,"Fidelity: "+str(Rover.fidelity)+'%', (0, 40), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"Rocks", (0, 55), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      cv2.putText(map_add,"  Located: "+str(samples_located), (0, 70), 
+      cv2.putText(map_add,"  Located: "+str(Rover.samples_located), (0, 70), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -154,7 +217,7 @@ def create_output_images(Rover):
       pil_img.save(buff, format="JPEG")
       encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
       
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      pil_img = Image.fromarray(Rover.vision_image)
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
@@ -0,0 +1,198 @@
+# Sweep mission parameters over simulated (see headless_sim.py) or recorded
+# (see telemetry_log.py) runs, spread over a process pool.  Every combination
+# of the --param values is run once per --seeds seed and scored on the mission
+# time it took to map each of the --targets percentages of the ground truth,
+# the final map fidelity and the samples collected.  The seed sets both the
+# simulated world and the random choices of the decision step, so a
+# configuration scores the same every time it is run.
+# Recorded runs replay a fixed trajectory: only the perception parameters
+# (the classifier thresholds) change anything there.
+# Example: $ python sweep.py --param throttle_set 0.2 0.4 --param stop_forward 200 300 --seeds 0 1 2
+#          $ python sweep.py --run run_folder --param rgb_thresh [150,150,150] [170,170,170]
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import time
+import numpy as np
+
+from perception import perception_step, CameraModel, TerrainClassifier
+from decision import decision_step
+from rover_state import RoverState, load_ground_truth, MISSION_PARAMS
+from supporting_functions import update_rover, update_history, update_map_statistics
+from telemetry_log import TelemetryReader, TIME_KEY
+from headless_sim import HeadlessSim
+
+# Classifier thresholds a configuration can set (see TerrainClassifier)
+CLASSIFIER_PARAMS = ('rgb_thresh', 'rgb_thresh_rock')
+
+# Camera model, ground truth and classifiers (keyed by their thresholds) of a
+# worker process, built on first use
+camera = None
+ground_truths = {}
+classifiers = {}
+
+# Define a function to return the classifier of a configuration, reusing the
+# worker's copy (building the lookup table takes a while)
+def config_classifier(config):
+    thresholds = {name: tuple(config[name]) for name in CLASSIFIER_PARAMS if name in config}
+    key = tuple(sorted(thresholds.items()))
+    if key not in classifiers:
+        classifiers[key] = TerrainClassifier(**thresholds)
+    return classifiers[key]
+
+# Define a function to score a run frame by frame: returns the mission time at
+# which each target percentage was first mapped (None until it is)
+def reached_targets(Rover, seconds, targets, reached):
+    update_map_statistics(Rover)
+    for idx, target in enumerate(targets):
+        if reached[idx] is None and Rover.perc_mapped >= target:
+            reached[idx] = seconds
+    return reached
+
+# Define a function to run one configuration with one seed.  Takes
+# (configuration id, configuration, seed, options) so it can run in a worker
+# process; returns a dict of results.
+def run_config(job):
+    global camera
+    config_id, config, seed, options = job
+    if camera is None:
+        camera = CameraModel()
+    if options['ground_truth'] not in ground_truths:
+        ground_truths[options['ground_truth']] = load_ground_truth(options['ground_truth'])
+    ground_truth = ground_truths[options['ground_truth']]
+    Rover = RoverState(ground_truth, camera, config_classifier(config), seed=seed)
+    Rover.configure({name: value for name, value in config.items() if name in MISSION_PARAMS})
+    targets = options['targets']
+    reached = [None] * len(targets)
+    start = time.time()
+    frames = 0
+    seconds = 0.
+    if options['run'] != '':
+        # Recorded run: the commands decided are not acted on
+        first_time = None
+        for data, frame in TelemetryReader(options['run']):
+            if frames >= options['frames']:
+                break
+            Rover = update_rover(Rover, data, np.ascontiguousarray(frame))
+            frames += 1
+            if first_time is None:
+                first_time = data.get(TIME_KEY, 0)
+            seconds = data[TIME_KEY] - first_time if TIME_KEY in data else frames * options['dt']
+            if not np.isfinite(Rover.vel):
+                continue
+            update_history(Rover)
+            perception_step(Rover)
+            decision_step(Rover)
+            Rover.send_pickup = False
+            reached = reached_targets(Rover, seconds, targets, reached)
+        samples_collected = Rover.samples_collected
+    else:
+        sim = HeadlessSim(ground_truth, camera, seed=seed, dt=options['dt'])
+        while sim.frames < options['frames']:
+            Rover = update_rover(Rover, sim.telemetry())
+            update_history(Rover)
+            perception_step(Rover)
+            decision_step(Rover)
+            reached = reached_targets(Rover, sim.time, targets, reached)
+            if Rover.send_pickup and not Rover.picking_up:
+                Rover.send_pickup = False
+                sim.pickup()
+            else:
+                sim.control(Rover.throttle, Rover.brake, Rover.steer)
+            sim.step()
+        frames = sim.frames
+        seconds = sim.time
+        samples_collected = int((~sim.remaining).sum())
+    result = {'config': config_id, 'seed': seed, 'frames': frames, 'mission_seconds': round(seconds, 1)}
+    for target, when in zip(targets, reached):
+        result['time_to_{:g}'.format(target)] = None if when is None else round(when, 1)
+    result.update({'perc_mapped': Rover.perc_mapped, 'fidelity': Rover.fidelity,
+                   'samples_located': Rover.samples_located, 'samples_collected': samples_collected,
+                   'wall_seconds': round(time.time() - start, 1)})
+    return result
+
+# Define a function to expand a parameter grid ({name: [values]}) into the
+# list of configurations, one dict per combination
+def grid_configs(grid):
+    names = sorted(grid)
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[name] for name in names])]
+
+# Define a function to run every configuration with every seed on the given
+# number of processes.  Returns the results, in configuration and seed order.
+def run_sweep(configs, seeds, options, processes=1):
+    jobs = [(config_id, config, seed, options) for config_id, config in enumerate(configs) for seed in seeds]
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(processes, len(jobs)))
+        try:
+            results = pool.map(run_config, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_config(job) for job in jobs]
+    return results
+
+# Define a function to average the results of each configuration over its
+# seeds.  A target time is only averaged if every seed reached the target.
+def summarize(configs, results):
+    summary = []
+    for config_id, config in enumerate(configs):
+        rows = [row for row in results if row['config'] == config_id]
+        averaged = {'config': config_id}
+        averaged.update(config)
+        for key in rows[0]:
+            if key in ('config', 'seed', 'frames', 'wall_seconds'):
+                continue
+            values = [row[key] for row in rows]
+            averaged[key] = None if None in values else round(float(np.mean(values)), 1)
+        summary.append(averaged)
+    return summary
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep mission parameters over simulated or recorded runs')
+    parser.add_argument('--param', type=str, nargs='+', action='append', default=[], metavar=('NAME', 'VALUE'),
+                        help='Parameter and the values to try (JSON, e.g. 0.3 or [160,160,160]).  Give it once per parameter.')
+    parser.add_argument('--grid', type=str, default='', help='JSON file of {parameter: [values]} (added to --param).')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0], help='Seeds to run every configuration with.')
+    parser.add_argument('--run', type=str, default='', help='Recorded run to replay instead of simulating.')
+    parser.add_argument('--ground_truth', type=str, default='../calibration_images/map_bw.png', help='World map.')
+    parser.add_argument('--frames', type=int, default=6000, help='Frames per run.')
+    parser.add_argument('--dt', type=float, default=0.05, help='Simulated seconds per frame.')
+    parser.add_argument('--targets', type=float, nargs='+', default=[40, 60, 80], help='Percentages of the map to time.')
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help='Worker processes.')
+    parser.add_argument('--output', type=str, default='', help='CSV file for the result of every run.')
+    args = parser.parse_args()
+
+    grid = {}
+    if args.grid != '':
+        with open(args.grid) as f:
+            grid.update(json.load(f))
+    for values in args.param:
+        if len(values) < 2:
+            parser.error('--param needs a name and at least one value')
+        grid[values[0]] = [json.loads(value) for value in values[1:]]
+    for name in grid:
+        if name not in MISSION_PARAMS + CLASSIFIER_PARAMS:
+            parser.error('Unknown parameter {} (choose from {})'.format(name, ', '.join(MISSION_PARAMS + CLASSIFIER_PARAMS)))
+    configs = grid_configs(grid)
+    options = {'run': args.run, 'ground_truth': args.ground_truth, 'frames': args.frames, 'dt': args.dt,
+               'targets': args.targets}
+
+    start = time.time()
+    results = run_sweep(configs, args.seeds, options, args.processes)
+    elapsed = time.time() - start
+    print('Ran {} configurations x {} seeds in {:.1f} s'.format(len(configs), len(args.seeds), elapsed))
+
+    summary = summarize(configs, results)
+    columns = list(summary[0].keys())
+    print(''.join('{:>18}'.format(column) for column in columns))
+    for row in summary:
+        print(''.join('{:>18}'.format('-' if row[column] is None else json.dumps(row[column])) for column in columns))
+    if args.output != '':
+        with open(args.output, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=['config'] + sorted(grid) + [key for key in results[0] if key != 'config'])
+            writer.writeheader()
+            for row in results:
+                writer.writerow(dict(row, **configs[row['config']]))
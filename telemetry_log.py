@@ -0,0 +1,151 @@
+import os
+import json
+import threading
+import collections
+import numpy as np
+
+# A recorded run is a directory holding:
+#   index.json          -> chunk list, frame shape, number of frames and frames dropped
+#   chunk_00000.npy     -> decoded camera frames, N x rows x cols x 3 uint8
+#   chunk_00000.json    -> the N raw telemetry dicts (without the image string)
+# The frame chunks are plain .npy files, so a reader can memory-map them with
+# np.load(mmap_mode='r') instead of loading the whole run into memory.
+INDEX_FILE = 'index.json'
+CHUNK_FRAMES = 'chunk_{:05d}.npy'
+CHUNK_TELEMETRY = 'chunk_{:05d}.json'
+# Telemetry key holding the base64 camera image, stored as a frame instead
+IMAGE_KEY = 'image'
+# Telemetry key added by the recorder with the wall-clock time of each frame
+TIME_KEY = 'record_time'
+
+# Define a class to write a recorded run chunk by chunk
+class TelemetryWriter():
+    def __init__(self, path, chunk_size=256, frame_shape=(160, 320, 3)):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.frame_shape = tuple(frame_shape)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # Frames and telemetry of the chunk being filled
+        self.frames = np.zeros((chunk_size,) + self.frame_shape, dtype=np.uint8)
+        self.telemetry = []
+        self.chunks = []
+        self.frame_count = 0
+        self.dropped = 0 # Frames the recorder had to drop (see AsyncRecorder)
+
+    # Add one frame (decoded RGB image) and its telemetry dict to the recording
+    def append(self, data, frame, timestamp=None):
+        record = {key: value for key, value in data.items() if key != IMAGE_KEY}
+        if timestamp is not None:
+            record[TIME_KEY] = timestamp
+        self.frames[len(self.telemetry)] = frame
+        self.telemetry.append(record)
+        self.frame_count += 1
+        if len(self.telemetry) == self.chunk_size:
+            self.flush()
+
+    # Write the current (possibly partial) chunk and refresh the index
+    def flush(self):
+        if len(self.telemetry) == 0:
+            return
+        chunk_id = len(self.chunks)
+        count = len(self.telemetry)
+        np.save(os.path.join(self.path, CHUNK_FRAMES.format(chunk_id)), self.frames[:count])
+        with open(os.path.join(self.path, CHUNK_TELEMETRY.format(chunk_id)), 'w') as f:
+            json.dump(self.telemetry, f)
+        self.chunks.append({'frames': CHUNK_FRAMES.format(chunk_id),
+                            'telemetry': CHUNK_TELEMETRY.format(chunk_id),
+                            'count': count})
+        self.telemetry = []
+        # Rewrite the index after every chunk so an interrupted run stays readable
+        index = {'frame_shape': list(self.frame_shape), 'chunk_size': self.chunk_size,
+                 'frame_count': self.frame_count, 'dropped': self.dropped, 'chunks': self.chunks}
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(index, f)
+
+    def close(self):
+        self.flush()
+
+# Define a class to record a run from the telemetry handler without touching
+# the disk there.  append() copies the frame into a free buffer of a fixed
+# pool and queues it; a background thread writes the queue out through a
+# TelemetryWriter.  The queue is bounded: when the writer falls behind, the
+# oldest queued frame is dropped (and counted) so the handler never waits.
+class AsyncRecorder():
+    def __init__(self, path, queue_size=64, chunk_size=256, frame_shape=(160, 320, 3)):
+        self.writer = TelemetryWriter(path, chunk_size, frame_shape)
+        self.queue_size = queue_size
+        self.pending = collections.deque() # Queued (telemetry dict, frame buffer, timestamp)
+        # One buffer per queue slot, plus the one being written
+        self.free = [np.zeros(frame_shape, dtype=np.uint8) for idx in range(queue_size + 1)]
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.recorded = 0 # Frames handed to the writer
+        self.dropped = 0 # Frames dropped because the queue was full
+        self.closed = False
+        self.worker = threading.Thread(target=self.work, name='recorder')
+        self.worker.daemon = True
+        self.worker.start()
+
+    # Queue one frame (decoded RGB image) and its telemetry dict, never blocks on I/O
+    def append(self, data, frame, timestamp=None):
+        record = {key: value for key, value in data.items() if key != IMAGE_KEY}
+        with self.lock:
+            if len(self.pending) >= self.queue_size:
+                old_record, old_frame, old_timestamp = self.pending.popleft()
+                self.free.append(old_frame)
+                self.dropped += 1
+            buffer = self.free.pop()
+            buffer[:] = frame
+            self.pending.append((record, buffer, timestamp))
+            self.ready.notify()
+
+    def work(self):
+        while True:
+            with self.lock:
+                while len(self.pending) == 0 and not self.closed:
+                    self.ready.wait()
+                if len(self.pending) == 0:
+                    return
+                record, buffer, timestamp = self.pending.popleft()
+                self.writer.dropped = self.dropped
+            self.writer.append(record, buffer, timestamp)
+            with self.lock:
+                self.free.append(buffer)
+                self.recorded += 1
+
+    # Write out the frames still queued and close the recording
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+        self.worker.join()
+        self.writer.dropped = self.dropped
+        self.writer.close()
+
+# Define a class to read a recorded run, yielding (telemetry dict, frame) pairs.
+# Frames are memory-mapped views into the chunk files.
+class TelemetryReader():
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.frame_shape = tuple(self.index['frame_shape'])
+        self.chunks = self.index['chunks']
+
+    def __len__(self):
+        return sum(chunk['count'] for chunk in self.chunks)
+
+    # Load one chunk: (list of telemetry dicts, memory-mapped frame stack)
+    def load_chunk(self, chunk_id):
+        chunk = self.chunks[chunk_id]
+        frames = np.load(os.path.join(self.path, chunk['frames']), mmap_mode='r')
+        with open(os.path.join(self.path, chunk['telemetry'])) as f:
+            telemetry = json.load(f)
+        return telemetry, frames
+
+    def __iter__(self):
+        for chunk_id in range(len(self.chunks)):
+            telemetry, frames = self.load_chunk(chunk_id)
+            for idx in range(len(telemetry)):
+                yield telemetry[idx], frames[idx]
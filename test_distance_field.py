@@ -0,0 +1,26 @@
+import numpy as np
+
+from distance_field import DistanceField
+
+# Define a function to build the field of a 20 x 20 map with a one-cell wall
+# (x = 10, y < 16) between the rover side and the goal at (12, 2)
+def walled_field():
+    navigable = np.ones((20, 20), dtype=bool)
+    navigable[:16, 10] = False
+    field = DistanceField(navigable.shape, tile=8)
+    field.set_goal(12, 2, navigable)
+    while field.pending:
+        field.advance()
+    return field
+
+def test_descent_around_wall():
+    field = walled_field()
+    # The cells just behind the wall are closer to the goal, but the way
+    # there goes round the end of the wall: head down (+y), not into it
+    heading = field.descent_heading(8.5, 2.5, 3)
+    assert heading is not None
+    assert 45 <= heading <= 135
+
+def test_descent_at_goal():
+    field = walled_field()
+    assert field.descent_heading(12.5, 2.5, 3) is None
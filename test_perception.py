@@ -0,0 +1,26 @@
+import numpy as np
+
+from benchmark import synthetic_frame, synthetic_telemetry
+from perception import perception_step, CameraModel, MAP_ENGINES
+from rover_state import RoverState
+from supporting_functions import update_rover, update_history
+
+# Define a function to run synthetic frames through perception with the given
+# camera options and map engine.  Returns the Rover.
+def perceive_frames(map_engine, n_frames=5, **camera_options):
+    rng = np.random.RandomState(0)
+    Rover = RoverState(np.zeros((200, 200, 3), dtype=np.uint8), CameraModel(**camera_options))
+    Rover.map_engine = map_engine
+    for idx in range(n_frames):
+        Rover = update_rover(Rover, synthetic_telemetry(rng, synthetic_frame(rng)))
+        update_history(Rover)
+        perception_step(Rover)
+    return Rover
+
+def test_small_max_range():
+    # With roi and a short max_range the view is smaller than a map cell in
+    # places, the raster engine must still composite it
+    for map_engine in MAP_ENGINES:
+        for max_range in (8, 15):
+            Rover = perceive_frames(map_engine, roi=True, max_range=max_range)
+            assert Rover.nav_angles is not None
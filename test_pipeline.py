@@ -0,0 +1,58 @@
+import time
+import eventlet
+import numpy as np
+
+from benchmark import synthetic_frame, synthetic_telemetry
+from metrics import FrameMetrics, events
+from pipeline import FrameRunner
+from rover_state import RoverState
+
+# Perception is slowed down by this much (seconds) so its stage stands out
+PERCEPTION_DELAY = 0.02
+
+# Define a function to run frames through a FrameRunner on a green thread,
+# as the telemetry handler does.  Returns the metrics of the run.
+def run_frames(mode, n_frames=20):
+    rng = np.random.RandomState(0)
+    telemetry = [synthetic_telemetry(rng, synthetic_frame(rng)) for idx in range(n_frames)]
+    metrics = FrameMetrics()
+    runner = FrameRunner(RoverState(np.zeros((200, 200, 3), dtype=np.uint8)), metrics, mode=mode)
+    perceive = runner.perceive
+
+    def slow_perceive():
+        time.sleep(PERCEPTION_DELAY)
+        perceive()
+
+    runner.perceive = slow_perceive
+
+    def simulate():
+        for data in telemetry:
+            runner.step(data)
+            eventlet.sleep(0)
+        runner.close()
+
+    quiet = events.quiet
+    events.quiet = True
+    try:
+        eventlet.spawn(simulate).wait()
+    finally:
+        events.quiet = quiet
+    return metrics
+
+# Define a function to check that the perception stage, not the update
+# stage, holds the time spent in perception
+def check_stages(metrics):
+    records = metrics.last()
+    assert len(records) > 0
+    perception = records[:, metrics.columns['t_perception_ms']]
+    update = records[:, metrics.columns['t_update_ms']]
+    assert (perception > 0).all()
+    assert np.median(perception) > PERCEPTION_DELAY * 1000 / 2
+    assert np.median(update) < PERCEPTION_DELAY * 1000 / 2
+
+def test_serial_times_perception():
+    check_stages(run_frames('serial'))
+
+def test_pipeline_times_perception():
+    # The wait for perception of the previous frame is the perception stage
+    check_stages(run_frames('pipeline'))
@@ -0,0 +1,163 @@
+import numpy as np
+
+# Side of a map tile at one cell per meter (a tile always covers 20 x 20 m
+# of the world, and so 20 x 20 pixels of the 1 pixel per meter inset map)
+TILE_METERS = 20
+
+# Define a class to hold a large 2-D array as square tiles which are only
+# allocated once something is written into them, so memory grows with the
+# area explored rather than with the size of the world.  Unallocated cells
+# (and cells outside the array) read as fill; writes outside the array are
+# dropped.  Every tile written to is flagged dirty until clear_dirty() (for
+# the display) and unsaved until take_unsaved() (for checkpoints).
+class TiledArray():
+    def __init__(self, shape, tile=TILE_METERS, dtype=np.int16, fill=0):
+        self.shape = (shape[0], shape[1])
+        self.tile = tile
+        self.dtype = np.dtype(dtype)
+        self.fill = fill
+        grid = (-(-self.shape[0] // tile), -(-self.shape[1] // tile))
+        # Position of each tile in the store.  Slot 0 is never written and
+        # stays all fill, unallocated tiles point there so reads need no masking.
+        self.index = np.zeros(grid, dtype=np.int32)
+        self.dirty = np.zeros(grid, dtype=bool)
+        self.unsaved = np.zeros(grid, dtype=bool)
+        # The allocated tiles, stacked (grown by doubling)
+        self.store = np.full((4, tile, tile), fill, dtype=self.dtype)
+        self.count = 1
+        # Tile and offset within the tile of every row and column, looked up
+        # rather than divided out for each cell
+        self.row_tile = np.arange(self.shape[0]) // tile * grid[1]
+        self.row_offset = np.arange(self.shape[0]) % tile * tile
+        self.col_tile = np.arange(self.shape[1]) // tile
+        self.col_offset = np.arange(self.shape[1]) % tile
+
+    # Number of bytes held by the allocated tiles
+    @property
+    def nbytes(self):
+        return (self.count - 1) * self.tile * self.tile * self.dtype.itemsize
+
+    # Allocate the tiles (flat tile keys, tile row * tile columns + tile col)
+    # which are not allocated yet
+    def allocate(self, keys):
+        missing = self.index.flat[keys] == 0
+        if not missing.any():
+            return
+        keys = np.unique(keys[missing])
+        if self.count + len(keys) > len(self.store):
+            size = len(self.store)
+            while size < self.count + len(keys):
+                size *= 2
+            store = np.full((size, self.tile, self.tile), self.fill, dtype=self.dtype)
+            store[:self.count] = self.store[:self.count]
+            self.store = store
+        self.index.flat[keys] = np.arange(self.count, self.count + len(keys))
+        self.count += len(keys)
+
+    # Read the cells (rows, cols), ints or int arrays
+    def __getitem__(self, key):
+        rows, cols = key
+        if np.isscalar(rows) and np.isscalar(cols):
+            return self.take(np.array([rows]), np.array([cols]))[0]
+        return self.take(np.asarray(rows), np.asarray(cols))
+
+    # Mask of the cells (rows, cols) inside the array (negatives wrap to huge unsigned values)
+    def inside(self, rows, cols):
+        return (rows.astype(np.uintp) < self.shape[0]) & (cols.astype(np.uintp) < self.shape[1])
+
+    def take(self, rows, cols):
+        inside = self.inside(rows, cols)
+        if not inside.all():
+            # Cells off the array read from the fill slot
+            rows = np.where(inside, rows, 0)
+            cols = np.where(inside, cols, 0)
+            ids = np.where(inside, self.index.take(self.row_tile.take(rows) + self.col_tile.take(cols)), 0)
+        else:
+            ids = self.index.take(self.row_tile.take(rows) + self.col_tile.take(cols))
+        offsets = ids * (self.tile * self.tile) + self.row_offset.take(rows) + self.col_offset.take(cols)
+        return self.store.reshape(-1).take(offsets)
+
+    # Write values to the cells (rows, cols), allocating their tiles
+    def put(self, rows, cols, values):
+        values = np.broadcast_to(values, rows.shape)
+        inside = self.inside(rows, cols)
+        if not inside.all():
+            rows, cols, values = rows[inside], cols[inside], values[inside]
+        if len(rows) == 0:
+            return
+        keys = self.row_tile.take(rows) + self.col_tile.take(cols)
+        self.allocate(keys)
+        offsets = self.index.take(keys) * (self.tile * self.tile) + self.row_offset.take(rows) + self.col_offset.take(cols)
+        self.store.reshape(-1)[offsets] = values
+        self.dirty.flat[keys] = True
+        self.unsaved.flat[keys] = True
+
+    # Same, with flat cell indices (row * columns + col)
+    def take_flat(self, cells):
+        return self.take(cells // self.shape[1], cells % self.shape[1])
+
+    def put_flat(self, cells, values):
+        self.put(cells // self.shape[1], cells % self.shape[1], values)
+
+    # Iterate over the tiles overlapping rows y0:y1 and columns x0:x1 (clipped
+    # to the array), yielding (tile row, tile col, slice of the tile, slice of the region)
+    def overlapping(self, y0, y1, x0, x1):
+        tile = self.tile
+        for tile_row in range(max(y0, 0) // tile, (min(y1, self.shape[0]) - 1) // tile + 1):
+            for tile_col in range(max(x0, 0) // tile, (min(x1, self.shape[1]) - 1) // tile + 1):
+                top = tile_row * tile
+                left = tile_col * tile
+                r0, r1 = max(y0, top), min(y1, top + tile, self.shape[0])
+                c0, c1 = max(x0, left), min(x1, left + tile, self.shape[1])
+                yield (tile_row, tile_col, (slice(r0 - top, r1 - top), slice(c0 - left, c1 - left)),
+                       (slice(r0 - y0, r1 - y0), slice(c0 - x0, c1 - x0)))
+
+    # Return a dense copy of rows y0:y1 and columns x0:x1
+    def region(self, y0, y1, x0, x1):
+        out = np.full((y1 - y0, x1 - x0), self.fill, dtype=self.dtype)
+        for tile_row, tile_col, in_tile, in_region in self.overlapping(y0, y1, x0, x1):
+            idx = self.index[tile_row, tile_col]
+            if idx > 0:
+                out[in_region] = self.store[idx][in_tile]
+        return out
+
+    # Write a dense block of values with its top left corner at (y0, x0)
+    def put_region(self, y0, x0, values):
+        y1 = y0 + values.shape[0]
+        x1 = x0 + values.shape[1]
+        for tile_row, tile_col, in_tile, in_region in self.overlapping(y0, y1, x0, x1):
+            if self.index[tile_row, tile_col] == 0:
+                self.allocate(np.array([tile_row * self.index.shape[1] + tile_col]))
+            self.store[self.index[tile_row, tile_col]][in_tile] = values[in_region]
+            self.dirty[tile_row, tile_col] = True
+            self.unsaved[tile_row, tile_col] = True
+
+    # Return the whole array as a dense copy
+    def dense(self):
+        return self.region(0, self.shape[0], 0, self.shape[1])
+
+    def clear_dirty(self):
+        self.dirty[:] = False
+
+    # Flat keys (tile row * tile columns + tile col) of the allocated tiles
+    def allocated(self):
+        return np.flatnonzero(self.index)
+
+    # Return the flat keys of the tiles written since the last call
+    def take_unsaved(self):
+        keys = np.flatnonzero(self.unsaved)
+        self.unsaved[:] = False
+        return keys
+
+    # Return a copy of the tiles with the given flat keys (all fill if unallocated)
+    def tiles(self, keys):
+        return self.store[self.index.flat[keys]]
+
+    # Write whole tiles (as returned by tiles()).  Unallocated tiles holding
+    # nothing but fill are left unallocated.
+    def put_tiles(self, keys, tiles):
+        used = (tiles != self.fill).any(axis=(1, 2)) | (self.index.flat[keys] > 0)
+        keys = keys[used]
+        self.allocate(keys)
+        self.store[self.index.flat[keys]] = tiles[used]
+        self.dirty.flat[keys] = True